@@ -1,2 +1,2 @@
-__all__ = ["container","utils","datamodel","registry","jeeves","database"]
+__all__ = ["container","utils","datamodel","registry","jeeves","database","aio","blobstore","skyindex","cache"]
 __version__ = "1.0.0"
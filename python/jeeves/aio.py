@@ -0,0 +1,222 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from .database import Database
+from .registry import Registry
+
+# asyncio front-end for the Jeeves registry and database
+#
+# All of the sqlite3 work is run in a dedicated executor so it never
+# blocks the event loop.  sqlite3 connections can only be used from one
+# thread at a time, so unless the database is pooled the executor only
+# gets a single worker thread.
+
+class AsyncDatabase(object):
+    """
+    Jeeves asyncio database object
+
+    Parameters
+    ----------
+    filename : str or Database, optional
+       Database filename or Database object.  Default is ':memory:'.
+    pool : bool, optional
+       Use a pooled Database so queries can run concurrently in several
+         worker threads.  Default is False.
+    executor : concurrent.futures.Executor, optional
+       Executor to run the database calls in.  By default a thread pool is
+         created with max_workers threads for a pooled database and a
+         single thread otherwise.
+    max_workers : int, optional
+       Number of worker threads for a pooled database.  Default is 8.
+
+    Examples
+    --------
+
+    db = AsyncDatabase('catalog.db',pool=True)
+    tab = await db.query(table='meas',where='ra>10')
+
+    """
+
+    def __init__(self,filename=':memory:',pool=False,executor=None,max_workers=8):
+        if isinstance(filename,Database):
+            self.database = filename
+        else:
+            self.database = Database(filename,pool=pool)
+        if executor is None:
+            if self.database.pool==False:
+                max_workers = 1
+            executor = ThreadPoolExecutor(max_workers=max_workers,
+                                          thread_name_prefix='jeeves-async')
+        self._executor = executor
+
+    def __repr__(self):
+        """ Print info """
+        out = '<Jeeves.AsyncDatabase>'
+        if self.database.filename is not None:
+            out += self.database.filename
+        return out
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self,*args):
+        await self.close()
+
+    async def _run(self,func,*args,**kwargs):
+        """ Run a function in the executor."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor,functools.partial(func,*args,**kwargs))
+
+    async def query(self,*args,**kwargs):
+        """ Run a query.  See Database.query()."""
+        return await self._run(self.database.query,*args,**kwargs)
+
+    async def iterquery(self,sql_or_table,**kwargs):
+        """
+        Iterate over the results of a query in chunks.  See Database.iterquery().
+
+        Examples
+        --------
+
+        async for tab in db.iterquery('meas',chunksize=100000):
+            process(tab)
+
+        """
+        # The cursor of a pooled database belongs to the thread that
+        #  started the query, so keep the whole iteration on one thread
+        if self.database.pool:
+            executor = ThreadPoolExecutor(max_workers=1,thread_name_prefix='jeeves-async')
+        else:
+            executor = self._executor
+        loop = asyncio.get_running_loop()
+        gen = None
+        try:
+            gen = await loop.run_in_executor(executor,functools.partial(self.database.iterquery,
+                                                                        sql_or_table,**kwargs))
+            while True:
+                chunk = await loop.run_in_executor(executor,next,gen,None)
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            if executor is not self._executor:
+                # Close the cursor and the connection of the iteration thread
+                #  so they do not pile up in the pooled database
+                if gen is not None:
+                    await loop.run_in_executor(executor,gen.close)
+                await loop.run_in_executor(executor,self.database._releaseconnection)
+                executor.shutdown(wait=False)
+
+    async def insert(self,*args,**kwargs):
+        """ Insert information into a table.  See Database.insert()."""
+        return await self._run(self.database.insert,*args,**kwargs)
+
+    async def update(self,*args,**kwargs):
+        """ Update rows in a table.  See Database.update()."""
+        return await self._run(self.database.update,*args,**kwargs)
+
+    async def delete(self,*args,**kwargs):
+        """ Delete rows in a table.  See Database.delete()."""
+        return await self._run(self.database.delete,*args,**kwargs)
+
+    async def sql(self,cmd):
+        """ Execute raw sql command or list of sql commands."""
+        return await self._run(self.database.sql,cmd)
+
+    async def exists(self,name):
+        """ Check if the table or name exists in the database."""
+        return await self._run(self.database.exists,name)
+
+    async def tables(self):
+        """ Return table names."""
+        return await self._run(self.database.tables)
+
+    async def columns(self,table):
+        """ Return table columns."""
+        return await self._run(self.database.columns,table)
+
+    async def close(self):
+        """ Close the database and shut down the executor."""
+        await self._run(self.database.close)
+        self._executor.shutdown(wait=False)
+
+
+class AsyncRegistry(object):
+    """
+    Jeeves asyncio registry object
+
+    Parameters
+    ----------
+    registry : str or Registry
+       Registry database filename or Registry object.
+    executor : concurrent.futures.Executor, optional
+       Executor to run the registry calls in.  By default a single
+         worker thread is used.
+
+    Examples
+    --------
+
+    reg = AsyncRegistry('exposure.db')
+    filename = await reg.retrieve(key)
+
+    """
+
+    def __init__(self,registry,executor=None):
+        if isinstance(registry,Registry):
+            self.registry = registry
+        else:
+            self.registry = Registry(database_filename=registry)
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=1,thread_name_prefix='jeeves-async')
+        self._executor = executor
+
+    def __repr__(self):
+        """ Print info """
+        out = '<Jeeves.AsyncRegistry>'
+        if self.registry.database_filename is not None:
+            out += self.registry.database_filename
+        return out
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self,*args):
+        await self.close()
+
+    async def _run(self,func,*args,**kwargs):
+        """ Run a function in the executor."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor,functools.partial(func,*args,**kwargs))
+
+    async def search(self,key):
+        """ Search for the key in the table."""
+        return await self._run(self.registry.search,key)
+
+    async def exists(self,key):
+        """ Check if the key exists in the registry."""
+        return await self._run(self.registry.exists,key)
+
+    async def retrieve(self,key):
+        """ Retrieve the filename for a key."""
+        return await self._run(self.registry.retrieve,key)
+
+    async def exists_many(self,keys):
+        """ Check if many keys exist in the registry."""
+        return await self._run(self.registry.exists_many,keys)
+
+    async def retrieve_many(self,keys):
+        """ Retrieve the filenames for many keys."""
+        return await self._run(self.registry.retrieve_many,keys)
+
+    async def add(self,key,filename):
+        """ Add data to the registry."""
+        return await self._run(self.registry.add,key,filename)
+
+    async def register(self,records,**kwargs):
+        """ Bulk add data to the registry.  See Registry.register()."""
+        return await self._run(self.registry.register,records,**kwargs)
+
+    async def close(self):
+        """ Close the registry and shut down the executor."""
+        await self._run(self.registry.closedb)
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,330 @@
+import io
+import hashlib
+from .database import opendb
+
+# Jeeves content-addressed blob store
+#
+# Payloads are split into fixed-size chunks that are stored once per
+# unique sha256 hash, so identical files (or identical parts of files)
+# are only stored once.  The chunks are written and read with sqlite3
+# incremental BLOB I/O so a payload never has to fit in memory.
+#
+# Tables
+#  blobs:      key, size, hash (sha256 of the full payload), nchunks
+#  blobmap:    key, seq, hash  (the ordered chunks of each payload)
+#  blobchunks: hash, size, data
+
+class BlobReader(io.RawIOBase):
+    """
+    File-like object to read a blob from a BlobStore.
+
+    Use BlobStore.open() to create one.
+    """
+
+    def __init__(self,db,chunks):
+        # chunks is a list of (rowid, size) for the chunks of the blob
+        self._db = db
+        self._rowids = [c[0] for c in chunks]
+        self._sizes = [c[1] for c in chunks]
+        self._offsets = [0]
+        for sz in self._sizes:
+            self._offsets.append(self._offsets[-1]+sz)
+        self.size = self._offsets[-1]
+        self._pos = 0
+        self._blob = None
+        self._blobindex = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self,offset,whence=io.SEEK_SET):
+        """ Change the stream position."""
+        if whence==io.SEEK_SET:
+            pos = offset
+        elif whence==io.SEEK_CUR:
+            pos = self._pos+offset
+        elif whence==io.SEEK_END:
+            pos = self.size+offset
+        else:
+            raise ValueError('whence value '+str(whence)+' not supported')
+        if pos<0:
+            raise ValueError('negative seek position '+str(pos))
+        self._pos = pos
+        return self._pos
+
+    def _openchunk(self,index):
+        """ Open the incremental BLOB handle for a chunk."""
+        if self._blobindex != index:
+            if self._blob is not None:
+                self._blob.close()
+            self._blob = self._db.blobopen('blobchunks','data',self._rowids[index],readonly=True)
+            self._blobindex = index
+        return self._blob
+
+    def readinto(self,b):
+        """ Read bytes into a pre-allocated, writable bytes-like object."""
+        mv = memoryview(b).cast('B')
+        nread = 0
+        while nread<len(mv) and self._pos<self.size:
+            # Find the chunk for the current position
+            index = self._chunkindex(self._pos)
+            blob = self._openchunk(index)
+            blob.seek(self._pos-self._offsets[index])
+            n = min(len(mv)-nread,self._offsets[index+1]-self._pos)
+            data = blob.read(n)
+            mv[nread:nread+len(data)] = data
+            nread += len(data)
+            self._pos += len(data)
+        return nread
+
+    def _chunkindex(self,pos):
+        """ Get the index of the chunk that contains a position."""
+        lo,hi = 0,len(self._sizes)-1
+        while lo<hi:
+            mid = (lo+hi+1)//2
+            if self._offsets[mid]<=pos:
+                lo = mid
+            else:
+                hi = mid-1
+        return lo
+
+    def close(self):
+        """ Close the reader."""
+        if self._blob is not None:
+            self._blob.close()
+            self._blob = None
+        super().close()
+
+
+class BlobStore(object):
+    """
+    Jeeves content-addressed blob store
+
+    Parameters
+    ----------
+    filename : str
+       Database filename.
+    chunksize : int, optional
+       Size of the chunks in bytes.  Default is 1MB.
+
+    Examples
+    --------
+
+    store = BlobStore('calib.db')
+    store.put('bias-20231004',biasfile)
+    with store.open('bias-20231004') as f:
+        header = f.read(2880)
+
+    """
+
+    def __init__(self,filename,chunksize=1048576):
+        self.filename = filename
+        self.chunksize = chunksize
+        self._db = None
+
+    def __repr__(self):
+        """ Print info """
+        out = '<Jeeves.BlobStore>'
+        if self.filename is not None:
+            out += self.filename
+        return out
+
+    @property
+    def db(self):
+        """ Return the db object."""
+        if self._db is None:
+            self._db = opendb(self.filename)
+            self._inittables()
+        return self._db
+
+    def close(self):
+        """ Close the database."""
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _inittables(self):
+        """ Initialize the blob store tables."""
+        cur = self._db.cursor()
+        cur.execute('CREATE TABLE IF NOT EXISTS blobs (key text PRIMARY KEY, size integer, hash text, nchunks integer)')
+        cur.execute('CREATE TABLE IF NOT EXISTS blobmap (key text, seq integer, hash text)')
+        cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_key_seq_blobmap ON blobmap(key,seq)')
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_hash_blobmap ON blobmap(hash)')
+        cur.execute('CREATE TABLE IF NOT EXISTS blobchunks (hash text PRIMARY KEY, size integer, data blob)')
+        self._db.commit()
+        cur.close()
+
+    def exists(self,key):
+        """ Check if the key exists in the blob store."""
+        cur = self.db.execute('SELECT key FROM blobs WHERE key=?',(key,))
+        return cur.fetchone() is not None
+
+    def keys(self):
+        """ Return all of the keys."""
+        cur = self.db.execute('SELECT key FROM blobs')
+        return [r[0] for r in cur.fetchall()]
+
+    def info(self,key):
+        """ Return size, hash and number of chunks of a blob."""
+        cur = self.db.execute('SELECT size,hash,nchunks FROM blobs WHERE key=?',(key,))
+        res = cur.fetchone()
+        if res is None:
+            raise KeyError(str(key)+' not found')
+        return {'size':res[0],'hash':res[1],'nchunks':res[2]}
+
+    def put(self,key,source,replace=False):
+        """
+        Store a payload in the blob store.
+
+        Parameters
+        ----------
+        key : str
+           Key of the payload.
+        source : str, bytes or file-like
+           Filename, bytes or a binary file-like object to read the payload from.
+        replace : bool, optional
+           Replace an existing payload with the same key.  Default is False.
+
+        Returns
+        -------
+        hash : str
+           sha256 hash of the full payload.
+
+        Examples
+        --------
+
+        hash = store.put('bias-20231004','bias.fits')
+
+        """
+        if isinstance(source,str):
+            with open(source,'rb') as f:
+                return self.put(key,f,replace=replace)
+        if isinstance(source,(bytes,bytearray,memoryview)):
+            return self.put(key,io.BytesIO(source),replace=replace)
+        db = self.db
+        cur = db.cursor()
+        try:
+            if self.exists(key):
+                if replace==False:
+                    raise ValueError(str(key)+' already exists')
+                self._delete(cur,key)
+            fullhash = hashlib.sha256()
+            size = 0
+            seq = 0
+            while True:
+                chunk = source.read(self.chunksize)
+                if len(chunk)==0:
+                    break
+                fullhash.update(chunk)
+                chash = hashlib.sha256(chunk).hexdigest()
+                # Only new chunks are stored
+                cur.execute('INSERT OR IGNORE INTO blobchunks (hash,size,data) VALUES (?,?,zeroblob(?))',
+                            (chash,len(chunk),len(chunk)))
+                if cur.rowcount==1:
+                    with db.blobopen('blobchunks','data',cur.lastrowid) as blob:
+                        blob.write(chunk)
+                cur.execute('INSERT INTO blobmap (key,seq,hash) VALUES (?,?,?)',(key,seq,chash))
+                size += len(chunk)
+                seq += 1
+            cur.execute('INSERT INTO blobs (key,size,hash,nchunks) VALUES (?,?,?,?)',
+                        (key,size,fullhash.hexdigest(),seq))
+            db.commit()
+        except:
+            db.rollback()
+            raise
+        finally:
+            cur.close()
+        return fullhash.hexdigest()
+
+    def open(self,key):
+        """
+        Open a payload for reading.
+
+        Parameters
+        ----------
+        key : str
+           Key of the payload.
+
+        Returns
+        -------
+        reader : BlobReader
+           Seekable, binary file-like object.
+
+        Examples
+        --------
+
+        with store.open('bias-20231004') as f:
+            data = f.read()
+
+        """
+        if self.exists(key)==False:
+            raise KeyError(str(key)+' not found')
+        cur = self.db.execute('SELECT c.rowid,c.size FROM blobmap m JOIN blobchunks c ON c.hash=m.hash '+
+                              'WHERE m.key=? ORDER BY m.seq',(key,))
+        chunks = cur.fetchall()
+        return io.BufferedReader(BlobReader(self.db,chunks),buffer_size=self.chunksize)
+
+    def get(self,key,filename=None):
+        """
+        Retrieve a payload.
+
+        Parameters
+        ----------
+        key : str
+           Key of the payload.
+        filename : str, optional
+           Stream the payload to this file.  By default the payload is
+             returned as bytes.
+
+        Returns
+        -------
+        data : bytes
+           The payload, if no filename was input.
+
+        Examples
+        --------
+
+        store.get('bias-20231004','bias.fits')
+
+        """
+        with self.open(key) as f:
+            if filename is None:
+                return f.read()
+            with open(filename,'wb') as out:
+                while True:
+                    chunk = f.read(self.chunksize)
+                    if len(chunk)==0:
+                        break
+                    out.write(chunk)
+
+    def _delete(self,cur,key):
+        """ Delete a payload and its unused chunks."""
+        cur.execute('SELECT DISTINCT hash FROM blobmap WHERE key=?',(key,))
+        hashes = [r[0] for r in cur.fetchall()]
+        cur.execute('DELETE FROM blobmap WHERE key=?',(key,))
+        cur.execute('DELETE FROM blobs WHERE key=?',(key,))
+        # Remove the chunks that are no longer used by any payload
+        for h in hashes:
+            cur.execute('DELETE FROM blobchunks WHERE hash=? AND NOT EXISTS '+
+                        '(SELECT 1 FROM blobmap WHERE hash=?)',(h,h))
+
+    def delete(self,key):
+        """ Delete a payload from the blob store."""
+        if self.exists(key)==False:
+            return
+        db = self.db
+        cur = db.cursor()
+        try:
+            self._delete(cur,key)
+            db.commit()
+        except:
+            db.rollback()
+            raise
+        finally:
+            cur.close()
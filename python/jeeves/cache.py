@@ -0,0 +1,445 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+import numpy as np
+from collections import OrderedDict
+from astropy.io import fits
+from astropy.table import Table
+from .container import DataContainer,DataBucket
+
+# Jeeves product cache
+#
+# Decoded DataContainers are kept in memory keyed by (kind, key, mtime)
+# of the file they were read from, so a product that is rewritten on disk
+# gets a new cache entry.  The least recently used products are evicted
+# when the total size of the cached data goes over the byte budget.
+#
+# The second tier is an on-disk cache of the decoded bucket arrays in
+# native byte order (.npy) with a FITS header sidecar (.hdr) for each
+# bucket, keyed by the sha256 hash of the source file.  The arrays are
+# memory-mapped when they are loaded, so all the processes on a node
+# share one decoded copy through the page cache.
+#
+# Disk cache layout
+#  HASH/product.json        bucket names, types, column units, source filename
+#  HASH/NNNN.npy, NNNN.hdr  data and header of bucket NNNN
+#  fingerprints/FPRINT      content hash of a source file, FPRINT is the hash
+#                           of its path, size, mtime and inode
+
+def containerbytes(container):
+    """ Return the number of bytes of the data in a DataContainer."""
+    nbytes = 0
+    for d in container.buckets:
+        # Lazy buckets have not read any data yet
+        if d.loaded==False:
+            continue
+        data = d.data
+        if isinstance(data,Table):
+            nbytes += sum([col.nbytes for col in data.itercols()])
+        elif isinstance(data,np.ndarray):
+            nbytes += data.nbytes
+    return nbytes
+
+
+class ProductCache(object):
+    """
+    In-memory LRU cache of decoded products.
+
+    Parameters
+    ----------
+    maxbytes : int, optional
+       Byte budget of the cache.  Default is 1GB.
+
+    Examples
+    --------
+
+    cache = ProductCache(maxbytes=4*1024**3)
+    dc = cache.get('bias','20231004',mtime)
+    if dc is None:
+        dc = DataContainer(filename)
+        dc = cache.put('bias','20231004',mtime,dc)
+
+    """
+
+    def __init__(self,maxbytes=1073741824):
+        self.maxbytes = maxbytes
+        self._entries = OrderedDict()   # (kind,key,mtime) -> (container,nbytes)
+        self._current = {}              # (kind,key) -> mtime of the cached entry
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __repr__(self):
+        """ Print info """
+        out = '<Jeeves.ProductCache {:d} products, {:d}/{:d} bytes, {:d} hits, {:d} misses>'
+        return out.format(len(self),self.nbytes,self.maxbytes,self.hits,self.misses)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self,cachekey):
+        return tuple(cachekey) in self._entries
+
+    def get(self,kind,key,mtime):
+        """
+        Get a product from the cache.
+
+        Parameters
+        ----------
+        kind : str
+           The file type/datamodel name.
+        key : str
+           The product key.
+        mtime : float
+           Modification time of the product file.
+
+        Returns
+        -------
+        container : DataContainer
+           A copy-on-write copy of the cached product, or None if it
+             is not in the cache.
+
+        Examples
+        --------
+
+        dc = cache.get('bias','20231004',os.path.getmtime(filename))
+
+        """
+        cachekey = (kind,key,mtime)
+        with self._lock:
+            if cachekey not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(cachekey)
+            self.hits += 1
+            container = self._entries[cachekey][0]
+        # Callers get their own copy that shares the data buffers
+        return container.copy(deep=False)
+
+    def put(self,kind,key,mtime,container):
+        """
+        Add a product to the cache.
+
+        The cache keeps the input container, so it should not be changed
+        afterwards, use the returned copy instead.  Products larger than
+        the byte budget are not cached.  An entry for an older version
+        (mtime) of the same product is replaced.
+
+        Parameters
+        ----------
+        kind : str
+           The file type/datamodel name.
+        key : str
+           The product key.
+        mtime : float
+           Modification time of the product file.
+        container : DataContainer
+           The decoded product.
+
+        Returns
+        -------
+        container : DataContainer
+           A copy-on-write copy of the product, or the input container
+             if it was not cached.
+
+        Examples
+        --------
+
+        dc = cache.put('bias','20231004',os.path.getmtime(filename),dc)
+
+        """
+        nbytes = containerbytes(container)
+        if nbytes>self.maxbytes:
+            return container
+        with self._lock:
+            # Remove the previous version of this product
+            oldmtime = self._current.get((kind,key))
+            if oldmtime is not None:
+                self._remove((kind,key,oldmtime))
+            self._entries[(kind,key,mtime)] = (container,nbytes)
+            self._current[(kind,key)] = mtime
+            self.nbytes += nbytes
+            # Evict the least recently used products
+            while self.nbytes>self.maxbytes:
+                cachekey = next(iter(self._entries))
+                self._remove(cachekey)
+                self.evictions += 1
+        # The caller gets a copy with read-only data, so changes to it
+        #  do not change the cache
+        return container.copy(deep=False)
+
+    def _remove(self,cachekey):
+        """ Remove an entry, the lock must be held."""
+        container,nbytes = self._entries.pop(cachekey)
+        self.nbytes -= nbytes
+        if self._current.get(cachekey[:2])==cachekey[2]:
+            del self._current[cachekey[:2]]
+
+    def discard(self,kind,key):
+        """ Remove a product from the cache."""
+        with self._lock:
+            mtime = self._current.get((kind,key))
+            if mtime is not None:
+                self._remove((kind,key,mtime))
+
+    def clear(self):
+        """ Empty the cache."""
+        with self._lock:
+            self._entries.clear()
+            self._current.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """ Return the cache statistics."""
+        with self._lock:
+            return {'products':len(self._entries),'nbytes':self.nbytes,'maxbytes':self.maxbytes,
+                    'hits':self.hits,'misses':self.misses,'evictions':self.evictions}
+
+
+def filehash(filename,chunksize=1048576):
+    """ Return the sha256 hash of the contents of a file."""
+    h = hashlib.sha256()
+    with open(filename,'rb') as f:
+        while True:
+            chunk = f.read(chunksize)
+            if len(chunk)==0:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class DiskCache(object):
+    """
+    On-disk cache of decoded products that is shared across processes.
+
+    Parameters
+    ----------
+    directory : str
+       Cache directory, ideally on a node-local disk.
+    maxbytes : int, optional
+       Byte budget of the cache, the least recently used products are
+         removed when it is exceeded.  By default there is no limit.
+
+    Examples
+    --------
+
+    disk = DiskCache('/tmp/jeeves-cache')
+    dc = disk.get(filename)
+    if dc is None:
+        dc = DataContainer(filename)
+        disk.put(filename,dc)
+
+    """
+
+    def __init__(self,directory,maxbytes=None):
+        self.directory = directory
+        self.maxbytes = maxbytes
+        os.makedirs(os.path.join(directory,'fingerprints'),exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        """ Print info """
+        out = '<Jeeves.DiskCache {:s}, {:d} hits, {:d} misses>'
+        return out.format(self.directory,self.hits,self.misses)
+
+    def hash(self,filename):
+        """
+        Return the content hash of a source file.
+
+        The hash is only computed once for every version of the file,
+        it is saved under a fingerprint of the file's path, size,
+        mtime and inode.
+        """
+        st = os.stat(filename)
+        fprint = '{:s}|{:d}|{:d}|{:d}'.format(os.path.abspath(filename),st.st_size,
+                                              st.st_mtime_ns,st.st_ino)
+        fprint = hashlib.sha256(fprint.encode()).hexdigest()
+        fprintfile = os.path.join(self.directory,'fingerprints',fprint)
+        if os.path.exists(fprintfile):
+            with open(fprintfile,'r') as f:
+                return f.read().strip()
+        chash = filehash(filename)
+        self._atomicwrite(fprintfile,chash)
+        return chash
+
+    def _atomicwrite(self,filename,text):
+        """ Write a text file atomically."""
+        fd,tempname = tempfile.mkstemp(dir=os.path.dirname(filename),prefix='.tmp')
+        with os.fdopen(fd,'w') as f:
+            f.write(text)
+        os.replace(tempname,filename)
+
+    def exists(self,filename):
+        """ Check if a source file is in the cache."""
+        return os.path.exists(os.path.join(self.directory,self.hash(filename),'product.json'))
+
+    def get(self,filename):
+        """
+        Get a decoded product from the cache.
+
+        Parameters
+        ----------
+        filename : str
+           The source filename.
+
+        Returns
+        -------
+        container : DataContainer
+           The product with read-only, memory-mapped data, or None if
+             it is not in the cache.
+
+        Examples
+        --------
+
+        dc = disk.get(filename)
+
+        """
+        pdir = os.path.join(self.directory,self.hash(filename))
+        productfile = os.path.join(pdir,'product.json')
+        try:
+            with open(productfile,'r') as f:
+                product = json.load(f)
+            container = DataContainer()
+            for i,b in enumerate(product['buckets']):
+                base = os.path.join(pdir,'{:04d}'.format(i))
+                with open(base+'.hdr','r') as f:
+                    head = fits.Header.fromstring(f.read())
+                data = None
+                if b['file']:
+                    data = np.load(base+'.npy',mmap_mode='r')
+                    if b['datatype']=='table':
+                        data = Table(data,copy=False)
+                        for c,unit in b['units'].items():
+                            data[c].unit = unit
+                container.add_bucket(DataBucket(data,head,b['name']),b['name'])
+        # The product was removed by another process
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        # Mark the product as recently used
+        os.utime(productfile)
+        self.hits += 1
+        return container
+
+    def put(self,filename,container):
+        """
+        Add a decoded product to the cache.
+
+        Parameters
+        ----------
+        filename : str
+           The source filename.
+        container : DataContainer
+           The decoded product.
+
+        Returns
+        -------
+        cached : bool
+           Was the product added, products with data that are not arrays
+             or tables cannot be cached.
+
+        Examples
+        --------
+
+        disk.put(filename,dc)
+
+        """
+        pdir = os.path.join(self.directory,self.hash(filename))
+        if os.path.exists(pdir):
+            return True
+        # Write to a temporary directory and rename it at the end,
+        #  so other processes never see a partial product
+        tempdir = tempfile.mkdtemp(dir=self.directory,prefix='.tmp')
+        try:
+            product = {'filename':os.path.abspath(filename),'buckets':[]}
+            for i,d in enumerate(container.buckets):
+                base = os.path.join(tempdir,'{:04d}'.format(i))
+                b = {'name':d.name,'datatype':d.datatype,'file':False,'units':{}}
+                data = d.data
+                # The raw storage of a FITS_rec is not scaled (TZERO/TSCAL)
+                #  and has logical columns as 'T'/'F' bytes, convert the columns
+                if isinstance(data,fits.FITS_rec):
+                    for col in data.columns:
+                        if col.unit:
+                            b['units'][col.name] = col.unit
+                    data = Table(data)
+                elif isinstance(data,Table):
+                    for c in data.colnames:
+                        if data[c].unit is not None:
+                            b['units'][c] = str(data[c].unit)
+                if isinstance(data,Table):
+                    data = data.as_array()
+                if data is not None:
+                    if isinstance(data,np.ndarray)==False or data.dtype.hasobject or \
+                       isinstance(data,np.ma.MaskedArray):
+                        shutil.rmtree(tempdir)
+                        return False
+                    # Native byte order so the data never has to be swapped again
+                    data = np.asarray(data)
+                    data = data.astype(data.dtype.newbyteorder('='),copy=False)
+                    np.save(base+'.npy',data)
+                    b['file'] = True
+                with open(base+'.hdr','w') as f:
+                    f.write(d.meta.to_header().tostring())
+                product['buckets'].append(b)
+            with open(os.path.join(tempdir,'product.json'),'w') as f:
+                json.dump(product,f)
+            try:
+                os.rename(tempdir,pdir)
+            # Another process cached it first
+            except OSError:
+                shutil.rmtree(tempdir)
+        except:
+            shutil.rmtree(tempdir,ignore_errors=True)
+            raise
+        if self.maxbytes is not None:
+            self.prune()
+        return True
+
+    def _products(self):
+        """ Return (last use time, size, directory) of the cached products."""
+        out = []
+        for d in os.listdir(self.directory):
+            pdir = os.path.join(self.directory,d)
+            productfile = os.path.join(pdir,'product.json')
+            if d.startswith('.') or os.path.exists(productfile)==False:
+                continue
+            try:
+                size = sum([os.path.getsize(os.path.join(pdir,f)) for f in os.listdir(pdir)])
+                out.append((os.path.getmtime(productfile),size,pdir))
+            except FileNotFoundError:
+                continue
+        return out
+
+    @property
+    def nbytes(self):
+        """ Return the total size of the cached products."""
+        return sum([p[1] for p in self._products()])
+
+    def prune(self,maxbytes=None):
+        """
+        Remove the least recently used products until the cache is
+        within the byte budget.  Processes that have the removed
+        arrays memory-mapped can keep using them.
+        """
+        if maxbytes is None:
+            maxbytes = self.maxbytes
+        if maxbytes is None:
+            return
+        products = sorted(self._products())
+        total = sum([p[1] for p in products])
+        for mtime,size,pdir in products:
+            if total<=maxbytes:
+                break
+            shutil.rmtree(pdir,ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        """ Remove all the cached products."""
+        self.prune(0)
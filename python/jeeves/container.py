@@ -1,6 +1,11 @@
 import os
+import io
+import re
+import gzip
 import numpy as np
 import copy
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from astropy.io import fits
 from astropy.wcs import WCS
 from astropy.table import Table
@@ -22,6 +27,178 @@ def getdatatype(data):
         datatype = 'None'
     return datatype
 
+# Table structure keywords that are recreated from the table data
+_tablekeys = re.compile(r'^(T(TYPE|FORM|UNIT|DIM|NULL|SCAL|ZERO|DISP)[0-9]+|TFIELDS|THEAP)$')
+# WCS keywords of the linear transformation, a new WCS can use a different set of them
+_wcsmatrixkeys = re.compile(r'^(CD[0-9]+_[0-9]+|PC[0-9]+_[0-9]+|CDELT[0-9]+|CROTA[0-9]+)$')
+
+def compression(compress):
+    """
+    Return the CompImageHDU keyword arguments of a compression setting.
+
+    compress can be None/False (no compression), True (RICE_1), a
+    compression type name ('RICE_1', 'GZIP_1', 'GZIP_2', 'HCOMPRESS_1'
+    or 'PLIO_1'), or a dictionary of CompImageHDU arguments, e.g.
+    {'compression_type':'RICE_1','quantize_level':16,'tile_shape':(1,2048)}.
+    """
+    if compress is None or compress is False:
+        return None
+    if compress is True:
+        return {'compression_type':'RICE_1'}
+    if isinstance(compress,str):
+        return {'compression_type':compress.upper()}
+    if isinstance(compress,dict):
+        return dict(compress)
+    raise ValueError('compress must be a bool, compression type or dictionary')
+
+def hdubytes(hdu,primary=False,checksum=False):
+    """
+    Serialize an HDU to the bytes it has in a FITS file.
+
+    Extensions can only be written after a primary HDU, so an empty
+    one is written first and then dropped.
+    """
+    buf = io.BytesIO()
+    if primary:
+        fits.HDUList([hdu]).writeto(buf,checksum=checksum)
+        return buf.getbuffer()
+    dummy = fits.PrimaryHDU()
+    fits.HDUList([dummy,hdu]).writeto(buf,checksum=checksum)
+    return buf.getbuffer()[len(dummy.header.tostring()):]
+
+def hdusection(hdu):
+    """ Return an object that reads parts of the image of an HDU. """
+    # Unscaled images are sliced straight from the memory-mapped data,
+    #  scaled or compressed images are read through the section
+    if isinstance(hdu,fits.CompImageHDU)==False and \
+       hdu.header.get('BSCALE',1)==1 and hdu.header.get('BZERO',0)==0:
+        return hdu.data
+    return hdu.section
+
+def sectionheader(header,slices):
+    """ Shift the WCS reference pixels of a header for an image section. """
+    if isinstance(slices,tuple)==False:
+        slices = (slices,)
+    naxis = header.get('NAXIS',0)
+    for i,sl in enumerate(slices):
+        # Numpy axis i is FITS axis naxis-i
+        axis = str(naxis-i)
+        if isinstance(sl,slice) and sl.step in [None,1] and 'CRPIX'+axis in header:
+            start = sl.indices(header.get('NAXIS'+axis,0))[0]
+            header['CRPIX'+axis] -= start
+    return header
+
+class TableColumns(object):
+    """
+    Column-by-column access to (selected rows of) a FITS table.
+
+    The columns are only read and converted from the memory-mapped
+    file when they are used.
+    """
+
+    def __init__(self,data,rows=None):
+        self._data = data
+        self._rows = rows
+        self._cache = {}
+
+    @property
+    def colnames(self):
+        return self._data.columns.names
+
+    def __getitem__(self,name):
+        if name not in self._cache:
+            col = self._data.field(name)
+            if self._rows is not None:
+                col = col[self._rows]
+            self._cache[name] = col
+        return self._cache[name]
+
+def readtable(hdu,columns=None,rows=None,where=None):
+    """
+    Read some of the columns and rows of a binary table HDU.
+
+    Only the needed columns are converted and copied out of the
+    memory-mapped file.
+
+    Parameters
+    ----------
+    hdu : BinTableHDU
+       The table HDU.
+    columns : list, optional
+       Names of the columns to read.  By default all columns are read.
+    rows : slice, range, tuple or array, optional
+       Rows to read, a (start,stop) tuple is a row range.  By default all rows are read.
+    where : function, optional
+       Row filter.  It is called with the table columns (columns that are
+         not read can be used too) and returns a boolean mask, e.g.
+         where=lambda t: t['mag']<20.
+
+    Returns
+    -------
+    tab : Table
+       Table with the selected columns and rows.
+
+    Examples
+    --------
+
+    tab = readtable(hdulist[1],['id','ra','dec'],where=lambda t: t['mag']<20)
+
+    """
+    data = hdu.data
+    if data is None:
+        return Table()
+    names = data.columns.names
+    if columns is None:
+        columns = names
+    # Match the column names case-insensitively
+    lnames = {n.lower():n for n in names}
+    for c in columns:
+        if c.lower() not in lnames:
+            raise ValueError('Column '+str(c)+' not found')
+    columns = [lnames[c.lower()] for c in columns]
+    if isinstance(rows,tuple):
+        rows = slice(*rows)
+    elif isinstance(rows,range):
+        rows = slice(rows.start,rows.stop,rows.step)
+    cols = TableColumns(data,rows)
+    mask = None
+    if where is not None:
+        mask = np.asarray(where(cols),bool)
+    tab = Table()
+    for c in columns:
+        col = cols[c]
+        if mask is not None:
+            col = col[mask]
+        tab[c] = np.array(col)
+        unit = data.columns[c].unit
+        if unit is not None:
+            tab[c].unit = unit
+    return tab
+
+def sharedview(data):
+    """ Return a read-only view of an array or table that shares its memory. """
+    if isinstance(data,Table):
+        new = Table(data,copy=False)
+        for col in new.itercols():
+            col.flags.writeable = False
+        return new
+    if isinstance(data,np.ndarray):
+        view = data.view()
+        view.flags.writeable = False
+        return view
+    return copy.deepcopy(data)
+
+def gethdutype(hdu):
+    """ Get the datatype of an HDU without loading its data. """
+    if hdu.is_image:
+        if hdu.header.get('NAXIS',0)==0:
+            datatype = 'None'
+        else:
+            datatype = 'ndarray'
+    else:
+        datatype = 'table'
+    return datatype
+
 def dowehavewcs(inp):
     """ Determine if a header has a real WCS. """
     if isinstance(inp,WCS):
@@ -46,16 +223,159 @@ def dowehavewcs(inp):
     #    return False
 
     
+def _parsecardvalue(card):
+    """ Parse the value of a raw 80-character header card."""
+    vstr = card[10:].strip()
+    # String value, quotes are escaped by doubling them
+    if vstr.startswith("'"):
+        out = ''
+        i = 1
+        while i<len(vstr):
+            if vstr[i]=="'":
+                if i+1<len(vstr) and vstr[i+1]=="'":
+                    out += "'"
+                    i += 2
+                    continue
+                break
+            out += vstr[i]
+            i += 1
+        return out.rstrip()
+    # Remove the comment
+    vstr = vstr.split('/')[0].strip()
+    if vstr=='':
+        return None
+    if vstr=='T':
+        return True
+    if vstr=='F':
+        return False
+    try:
+        return int(vstr)
+    except ValueError:
+        pass
+    try:
+        return float(vstr.replace('D','E'))
+    except ValueError:
+        return vstr
+
+def scanheader(filename,keys=None,exten=0):
+    """
+    Read header keywords directly from the raw 2880-byte FITS header blocks.
+
+    This skips building an astropy Header, WCS or history and is much
+    faster when only a few keywords are needed.  Long-string (CONTINUE)
+    and HIERARCH keywords are not supported.
+
+    Parameters
+    ----------
+    filename : str
+       FITS filename (can be gzip-compressed).
+    keys : list, optional
+       Keywords to read.  By default all keywords are returned.
+    exten : int, optional
+       Extension number.  Default is 0.
+
+    Returns
+    -------
+    values : dict
+       Dictionary of keyword values.  Requested keywords that are not
+         in the header are set to None.
+
+    Examples
+    --------
+
+    values = scanheader('image.fits',['DATE-OBS','RA','DEC','FILTER'])
+
+    """
+    if os.path.exists(filename)==False:
+        raise FileNotFoundError(filename)
+    if keys is not None:
+        keys = [k.upper() for k in keys]
+    if filename.endswith('.gz'):
+        f = gzip.open(filename,'rb')
+    else:
+        f = open(filename,'rb')
+    try:
+        for i in range(exten+1):
+            values = {}
+            done = False
+            while done==False:
+                block = f.read(2880)
+                if len(block)<2880:
+                    raise IndexError('Extension number too large')
+                block = block.decode('ascii',errors='replace')
+                for j in range(0,2880,80):
+                    card = block[j:j+80]
+                    key = card[:8].strip()
+                    if key=='END':
+                        done = True
+                        break
+                    if card[8:10]!='= ':
+                        continue
+                    # Only parse the needed keywords
+                    if i<exten:
+                        if key not in ['BITPIX','PCOUNT','GCOUNT'] and key.startswith('NAXIS')==False:
+                            continue
+                    elif keys is not None and key not in keys:
+                        continue
+                    values[key] = _parsecardvalue(card)
+            # Skip the data
+            if i<exten:
+                naxis = values.get('NAXIS',0)
+                if naxis>0:
+                    size = 1
+                    for k in range(naxis):
+                        size *= values.get('NAXIS'+str(k+1),0)
+                    size = abs(values.get('BITPIX',8))//8 * values.get('GCOUNT',1) * (values.get('PCOUNT',0)+size)
+                    f.seek(int(np.ceil(size/2880))*2880,1)
+    finally:
+        f.close()
+    if keys is not None:
+        values = {k:values.get(k) for k in keys}
+    return values
+
+def scanheaders(filenames,keys=None,exten=0,nthreads=8):
+    """
+    Read header keywords of many files in parallel.
+
+    Parameters
+    ----------
+    filenames : list
+       List of FITS filenames.
+    keys : list, optional
+       Keywords to read.  By default all keywords are returned.
+    exten : int, optional
+       Extension number.  Default is 0.
+    nthreads : int, optional
+       Number of threads.  Default is 8.
+
+    Returns
+    -------
+    values : list
+       List of dictionaries of keyword values, one per file.
+
+    Examples
+    --------
+
+    values = scanheaders(files,['DATE-OBS','RA','DEC','FILTER'])
+
+    """
+    if nthreads<=1:
+        return [scanheader(f,keys,exten) for f in filenames]
+    with ThreadPoolExecutor(max_workers=nthreads) as executor:
+        values = list(executor.map(lambda f: scanheader(f,keys,exten),filenames))
+    return values
+    
 class HistoryList(object):
     """" Contain history """
 
-    def __init__(self,header):
+    def __init__(self,header=None):
         # Parse through the history and grab all of
         # the HISTORY and COMMENT lines
         history = []
-        for k,v,c in header.cards:
-            if k == 'HISTORY':
-                history.append(v)
+        if header is not None:
+            for k,v,c in header.cards:
+                if k == 'HISTORY':
+                    history.append(v)
         self.data = history
 
     # Add methods
@@ -76,41 +396,283 @@ class HistoryList(object):
             head.add_history(d)
         return head
     
+    def copy(self,deep=False):
+        """ Make a copy, the history strings are shared unless deep=True """
+        if deep:
+            return copy.deepcopy(self)
+        new = HistoryList()
+        new.data = list(self.data)
+        return new
+    
+class HeaderStore(object):
+    """ Compact, ordered store of header keyword/value/comment cards """
+
+    __slots__ = ('_keys','_values','_comments','_index')
+
+    # Keywords that can appear more than once
+    _commentary = ['COMMENT','HISTORY','']
+
+    def __init__(self):
+        self._keys = []
+        self._values = []
+        self._comments = []
+        self._index = {}
+
+    def append(self,key,value,comment=''):
+        """ Add a card, an existing keyword is updated """
+        key = key.upper()
+        if key not in self._commentary and key in self._index:
+            i = self._index[key]
+            self._values[i] = value
+            self._comments[i] = comment
+            return
+        if key not in self._commentary:
+            self._index[key] = len(self._keys)
+        self._keys.append(key)
+        self._values.append(value)
+        self._comments.append(comment)
+
+    def __getitem__(self,key):
+        return self._values[self._index[key.upper()]]
+
+    def __setitem__(self,key,value):
+        key = key.upper()
+        if key in self._index:
+            self._values[self._index[key]] = value
+        else:
+            self.append(key,value)
+
+    def __delitem__(self,key):
+        i = self._index[key.upper()]
+        del self._keys[i]
+        del self._values[i]
+        del self._comments[i]
+        # Rebuild the index
+        self._index = {k:j for j,k in enumerate(self._keys) if k not in self._commentary}
+
+    def __contains__(self,key):
+        return key.upper() in self._index
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def get(self,key,default=None):
+        """ Get a value """
+        i = self._index.get(key.upper())
+        if i is None:
+            return default
+        return self._values[i]
+
+    def comment(self,key):
+        """ Get the comment of a keyword """
+        return self._comments[self._index[key.upper()]]
+
+    def items(self):
+        """ Get key/value pairs of the non-commentary keywords """
+        return [(k,self._values[i]) for k,i in self._index.items()]
+
+    def cards(self):
+        """ Get all key/value/comment cards """
+        return list(zip(self._keys,self._values,self._comments))
+
+    def to_header(self):
+        """ Make a FITS header """
+        return fits.Header(self.cards())
+
     def copy(self):
-        """ Make a copy """
-        return copy.deepcopy(self)
+        """ Make a copy, the values are immutable so only the lists are copied """
+        new = HeaderStore()
+        new._keys = list(self._keys)
+        new._values = list(self._values)
+        new._comments = list(self._comments)
+        new._index = dict(self._index)
+        return new
+    
+class MetaHeader(fits.Header):
+    """
+    FITS header of a MetaData object
+
+    Changes made through the Header methods are written back to the
+    MetaData.  Changes made directly to the Card objects are not.
+    """
+
+    # Header methods that change the header
+    _changemethods = ['__setitem__','__delitem__','__iadd__','set','append','extend',
+                      'update','insert','remove','pop','popitem','clear','setdefault',
+                      'rename_keyword','strip','add_history','add_comment','add_blank']
+
+    def __init__(self,cards=[],copy=False,meta=None):
+        self._meta = None
+        self._depth = 0
+        super().__init__(cards,copy=copy)
+        self._meta = meta
+
+    def _sync(self):
+        """ Write the header back to the MetaData."""
+        if self._meta is not None:
+            self._meta.header = self
+            self._meta.history = HistoryList(self)
+
+def _writethrough(name):
+    """ Wrap a Header method so the change is written back to the MetaData."""
+    method = getattr(fits.Header,name)
+    @functools.wraps(method)
+    def wrapper(self,*args,**kwargs):
+        # Methods call each other, only sync once at the end
+        self._depth += 1
+        try:
+            out = method(self,*args,**kwargs)
+        finally:
+            self._depth -= 1
+        if self._depth==0:
+            self._sync()
+        return out
+    return wrapper
+
+for name in MetaHeader._changemethods:
+    setattr(MetaHeader,name,_writethrough(name))
+
     
 class MetaData(object):
     """ Container for metadata/header """
 
+    __slots__ = ('_store','_shared','_wcs','_wcsloaded','_haswcs','_wcsorig','history')
+
+    # Header keywords that are not metadata items
+    _ignorekeys = ['HISTORY','COMMENT','SIMPLE','EXTEND','XTENSION','']
+
     def __init__(self,header=None):
         self.header = header
-        if header is not None:
-            self._make_properties()
-        # Create WCS object if it exists
-        self.wcs = WCS(header)
         self.history = HistoryList(header)
-            
-    def _make_properties(self):
-        """ Make properties for each header key """
-        for k,v in self.header.items():
-            if k not in ['HISTORY','COMMENT','SIMPLE','EXTEND','XTENSION']:
-                setattr(self,k.lower(),v)
+
+    def __getattr__(self,name):
+        """ Get header values as attributes """
+        # Private names are never header keys, this also keeps
+        #  copy/pickle working before the store is set
+        if name.startswith('_'):
+            raise AttributeError(name)
+        key = name.upper()
+        if key not in self._ignorekeys and key in self._store:
+            return self._store[key]
+        raise AttributeError(name)
+
+    def __setattr__(self,name,value):
+        """ Set header values as attributes """
+        if name.startswith('_') or name in MetaData.__slots__ or hasattr(type(self),name):
+            object.__setattr__(self,name,value)
+        else:
+            self._changestore()
+            self._store[name] = value
+
+    def __delattr__(self,name):
+        """ Delete header values """
+        if name.startswith('_') or name in MetaData.__slots__ or hasattr(type(self),name):
+            object.__delattr__(self,name)
+        else:
+            try:
+                self._changestore()
+                del self._store[name]
+            except KeyError:
+                raise AttributeError(name)
+        
+    @property
+    def header(self):
+        """
+        Return the header.
+
+        Changes made to the returned header are written back to the
+        metadata, e.g. meta.header['OBJECT'] = 'M31'.
+        """
+        return MetaHeader(self.to_header(),meta=self)
+
+    @header.setter
+    def header(self,value):
+        """ Set the header, the WCS is rebuilt on the next use."""
+        self._store = HeaderStore()
+        self._shared = False
+        if value is not None:
+            for card in value.cards:
+                # History is kept in the HistoryList
+                if card.keyword != 'HISTORY':
+                    self._store.append(card.keyword,card.value,card.comment)
+        self._clearwcs()
+
+    def _ownstore(self):
+        """ Copy a header store that is shared with a copy before changing it."""
+        if self._shared:
+            self._store = self._store.copy()
+            self._shared = False
+
+    def _changestore(self):
+        """ Get the header store ready for a change of a keyword."""
+        self._ownstore()
+        # Keep a WCS that was set or changed, the WCS is rebuilt
+        #  from the header on the next use
+        whead = self._wcsheader()
+        if whead is not None:
+            for k in list(self._store):
+                if _wcsmatrixkeys.match(k):
+                    del self._store[k]
+            for card in whead.cards:
+                self._store.append(card.keyword,card.value,card.comment)
+        self._clearwcs()
+
+    def _clearwcs(self):
+        """ Clear the cached WCS."""
+        self._wcs = None
+        self._wcsloaded = False
+        self._haswcs = None
+        self._wcsorig = None
+
+    def _wcsheader(self):
+        """
+        Return the header of the WCS if it was set or changed after it
+        was built from the header, otherwise None.
+        """
+        if self._wcsloaded==False or self.haswcs==False:
+            return None
+        whead = self._wcs.to_header()
+        if self._wcsorig is not None and whead.tostring()==self._wcsorig:
+            return None
+        return whead
+
+    @property
+    def wcs(self):
+        """ Return the WCS, it is only created from the header on first use."""
+        if self._wcsloaded==False:
+            # Binary tables do not have an image WCS
+            if len(self._store)>0 and self._store.get('XTENSION')!='BINTABLE':
+                self._wcs = WCS(self._store.to_header())
+                # To tell if the WCS is changed later
+                self._wcsorig = self._wcs.to_header().tostring()
+            self._wcsloaded = True
+        return self._wcs
+
+    @wcs.setter
+    def wcs(self,value):
+        """ Set the WCS, it is put in the header when that is made."""
+        self._wcs = value
+        self._wcsloaded = True
+        self._haswcs = None
+        self._wcsorig = None
+
+    def get(self,key,default=None):
+        """ Get a header value """
+        return self._store.get(key,default)
 
     def items(self):
         """ Get key/value pairs """
-        keystoignore = ['wcs','to_header','header','history',
-                        'items','copy','haswcs','info']
-        out = []
-        for d in dir(self):
-            if d[0] != '_' and d not in keystoignore:
-                out.append((d,getattr(self,d)))
-        return out
+        return [(k.lower(),v) for k,v in self._store.items() if k not in self._ignorekeys]
 
     @property
     def haswcs(self):
         """ Do we have a valid WCS. """
-        return dowehavewcs(self.wcs)
+        if self._haswcs is None:
+            self._haswcs = self.wcs is not None and dowehavewcs(self.wcs)
+        return self._haswcs
     
     def __repr__(self):
         """ Represent the object """
@@ -136,38 +698,57 @@ class MetaData(object):
     
     def to_header(self):
         """ Make a FITS header """
-        if self.header is not None:
-            head = self.header.copy()  # start with initial header
-        else:
-            head = fits.Header()
-        # Delete all history lines
-        try:
-            del head['HISTORY']
-        except:
-            pass
-        # Update all key/value pairs
-        for d in self.items():
-            head[d[0]] = d[1]
-        # wcs to header
-        if self.haswcs:
-            whead = self.wcs.to_header()
-            head += whead
+        head = self._store.to_header()
+        # The WCS was set or changed, replace the WCS keywords
+        whead = self._wcsheader()
+        if whead is not None:
+            for k in list(head.keys()):
+                if _wcsmatrixkeys.match(k):
+                    del head[k]
+            head.update(whead)
         # Add history
         histhead = self.history.to_header()
         head += histhead
         return head
 
-    def copy(self):
-        """ Make a copy """
-        return copy.deepcopy(self)
+    def copy(self,deep=False):
+        """
+        Make a copy
+
+        The copy shares the header values with this object until
+        one of them is changed.  Use deep=True for a full copy.
+        """
+        if deep:
+            new = copy.deepcopy(self)
+            new._shared = False
+            return new
+        new = self.__class__.__new__(self.__class__)
+        new._store = self._store
+        new._shared = True
+        self._shared = True
+        new._wcs = None
+        if self._wcsloaded and self._wcs is not None:
+            new._wcs = self._wcs.deepcopy()
+        new._wcsloaded = self._wcsloaded
+        new._haswcs = self._haswcs
+        new._wcsorig = self._wcsorig
+        new.history = self.history.copy()
+        return new
 
     @classmethod
-    def read(cls,filename,exten=0):
+    def read(cls,filename,exten=0,keys=None):
         """
         Read a file
+
+        If keys is given, only those keywords are read from the raw
+        header blocks.
         """
         if os.path.exists(filename)==False:
             raise FileNotFoundError(filename)
+        if keys is not None:
+            values = scanheader(filename,keys,exten)
+            head = fits.Header([(k,v) for k,v in values.items() if v is not None])
+            return MetaData(head)
         head = fits.getheader(filename,exten)
         return MetaData(head)
         
@@ -183,19 +764,119 @@ class MetaData(object):
 class DataBucket(object):
     """ Container for data and metadata/header """
     
-    def __init__(self,data=None,header=None,name=None):
-        self.data = data
+    def __init__(self,data=None,header=None,name=None,hdu=None):
+        # hdu is an (memory-mapped) HDU that the data is read
+        #  from the first time it is accessed
+        self._data = data
+        self._hdu = None
+        # The data is shared with a copy (copy-on-write)
+        self._shared = False
+        if data is None and hdu is not None:
+            self._hdu = hdu
         self.meta = MetaData(header)
         self.name = name
+        if self._hdu is not None:
+            self.datatype = gethdutype(hdu)
+        else:
+            self.datatype = getdatatype(data)
+
+    @property
+    def data(self):
+        """ Return the data, reading it from the HDU if necessary """
+        if self._hdu is not None:
+            self.load()
+        return self._data
+
+    @data.setter
+    def data(self,data):
+        """ Set the data """
+        self._data = data
+        self._hdu = None
+        self._shared = False
         self.datatype = getdatatype(data)
-                
+
+    def __getitem__(self,index):
+        # Only read the needed part of a lazy image
+        if self.loaded==False and self.datatype=='ndarray':
+            return np.array(hdusection(self._hdu)[index])
+        return self.data[index]
+
+    def select(self,columns=None,rows=None,where=None):
+        """
+        Return some of the columns and rows of a table bucket as a Table.
+
+        Lazy buckets only read the needed columns from the file, see readtable().
+        """
+        if self.datatype!='table':
+            raise ValueError('Columns and rows can only be selected for tables')
+        if self.loaded==False:
+            return readtable(self._hdu,columns,rows,where)
+        tab = Table(self.data,copy=False)
+        if columns is not None:
+            tab = tab[columns]
+        if isinstance(rows,tuple):
+            rows = slice(*rows)
+        if rows is not None:
+            tab = tab[rows]
+        if where is not None:
+            tab = tab[np.asarray(where(tab),bool)]
+        return tab.copy()
+
+    @property
+    def section(self):
+        """
+        Index the image data without loading all of it, e.g.
+        bucket.section[100:164,200:264].  Lazy buckets only read
+        the needed part of the file.
+        """
+        if self.loaded==False and self.datatype=='ndarray':
+            return hdusection(self._hdu)
+        return self.data
+
+    def __setitem__(self,index,value):
+        """ Change the data, shared data is copied first """
+        self.load()
+        self._own()
+        self._data[index] = value
+
+    def _own(self):
+        """ Make a private, writeable copy of data that is shared or read-only """
+        if isinstance(self._data,Table):
+            readonly = any([col.flags.writeable==False for col in self._data.itercols()])
+            if self._shared or readonly:
+                self._data = self._data.copy()
+        elif isinstance(self._data,np.ndarray):
+            if self._shared or self._data.flags.writeable==False:
+                self._data = np.array(self._data)
+        self._shared = False
+
+    @property
+    def loaded(self):
+        """ Has the data been loaded yet """
+        return self._hdu is None
+
+    def load(self):
+        """ Read the data from the HDU (lazy buckets only) """
+        if self._hdu is not None:
+            self._data = self._hdu.data
+            self._hdu = None
+            
     def __repr__(self):
         """ Represent the object """
         out = self.__class__.__name__ + '('
         if self.name is not None:
             out += 'name=' + self.name + ', '
         out += 'type=' + self.datatype + ', '
-        if self.data is not None:
+        # Lazy bucket, get the size from the header
+        if self.loaded==False:
+            if self.datatype == 'table':
+                out += 'size=' + str(self._hdu.header.get('NAXIS2',0)) + 'R x '
+                out += str(self._hdu.header.get('TFIELDS',0)) + 'C)\n'
+            elif self.datatype == 'ndarray':
+                out += 'size=' + repr(tuple(reversed(self._hdu.shape))) + ')\n'
+            else:
+                out += 'size=None)\n'
+        elif self.data is not None:
             if self.datatype == 'table':
                 out += 'size=' + str(len(self.data)) + 'R x '
                 out += str(len(self.data.dtype.names)) + 'C)\n'
@@ -232,52 +913,182 @@ class DataBucket(object):
         """ Do we have a WCS """
         return self.meta.haswcs
     
-    def to_hdulist(self):
-        """ Make a HDUList """
-        if isinstance(self.data,Table):
-            hdu = fits.table_to_hdu(self.data)
-            hdu.header += self.meta.to_header()
+    def to_hdulist(self,primary=False,compress=None):
+        """
+        Make an HDU, a PrimaryHDU if primary=True
+
+        Images are tile-compressed into a CompImageHDU with the compress
+        setting, see compression().  Compressed images cannot be primary HDUs.
+        """
+        settings = compression(compress)
+        if self.datatype=='table':
+            if primary:
+                raise ValueError('Tables cannot be in the primary HDU')
+            if isinstance(self.data,Table):
+                hdu = fits.table_to_hdu(self.data)
+            else:
+                hdu = fits.BinTableHDU(data=self.data)
+            # The table structure keywords come from the data
+            head = self.meta.to_header()
+            for k in list(head.keys()):
+                if _tablekeys.match(k):
+                    del head[k]
+            hdu.header.extend(head,update=True)
+        elif settings is not None and self.datatype=='ndarray':
+            if primary:
+                raise ValueError('Compressed images cannot be in the primary HDU')
+            hdu = fits.CompImageHDU(data=self.data,header=self.meta.to_header(),
+                                    **settings)
+        elif primary:
+            hdu = fits.PrimaryHDU(data=self.data,
+                                  header=self.meta.to_header())
         else:
             hdu = fits.ImageHDU(data=self.data,
                                 header=self.meta.to_header())
-        if self.name is not None:
+        if self.name is not None and (primary==False or self.name!='primary'):
             hdu.header['extname'] = self.name
         return hdu
 
-    def copy(self):
-        """ Make a copy """
-        return copy.deepcopy(self)
+    def copy(self,deep=True):
+        """
+        Make a copy
+
+        By default this is a full copy.  With deep=False the copy shares
+        the data and header with this bucket (copy-on-write): the data of
+        both buckets is then read-only, and a bucket copies the shared
+        data the first time it is changed with bucket[index]=value.
+        """
+        self.load()
+        if deep:
+            new = copy.deepcopy(self)
+            new._own()
+            return new
+        new = DataBucket(name=self.name)
+        if self._data is not None:
+            if self._shared==False:
+                self._data = sharedview(self._data)
+                self._shared = True
+            new._data = sharedview(self._data)
+            new._shared = True
+        new.datatype = self.datatype
+        new.meta = self.meta.copy()
+        return new
 
     @classmethod
-    def read(cls,filename,exten=0):
+    def read(cls,filename,exten=0,lazy=False,columns=None,rows=None,where=None):
         """
         Read from a fits file
+
+        With lazy=True the file is memory-mapped and the data is
+        only read when it is accessed.  For tables only some of the
+        columns and rows can be read, see readtable().
         """
         if os.path.exists(filename)==False:
             raise FileNotFoundError(filename)
-        hdu = fits.open()
-        if exten>=len(hdu):
+        hdulist = fits.open(filename)
+        if isinstance(exten,int) and exten>=len(hdulist):
+            hdulist.close()
             raise IndexError('Extension number too large')
-        data = hdu[exten].data.copy()
-        head = hdu[exten].header.copy()
-        hdu.close()
-        return Databucket(data,head)
+        hdu = hdulist[exten]
+        name = hdu.header.get('extname')
+        # Table subset
+        if columns is not None or rows is not None or where is not None:
+            if gethdutype(hdu)!='table':
+                hdulist.close()
+                raise ValueError('Columns and rows can only be selected for tables')
+            data = readtable(hdu,columns,rows,where)
+            head = hdu.header.copy()
+            hdulist.close()
+            return DataBucket(data,head,name)
+        if lazy:
+            # The HDU keeps the memory-mapped file open
+            return DataBucket(header=hdu.header,name=name,hdu=hdu)
+        data = hdu.data
+        if data is not None:
+            data = data.copy()
+        head = hdu.header.copy()
+        hdulist.close()
+        return DataBucket(data,head,name)
+
+    @classmethod
+    def read_section(cls,filename,exten=0,slices=None):
+        """
+        Read part of an image from a fits file.
+
+        Only the needed rows (or tiles of compressed images) are read
+        from disk.  The WCS reference pixels are shifted for the section.
+
+        Parameters
+        ----------
+        filename : str
+           FITS filename.
+        exten : int or str, optional
+           Extension number or name.  Default is 0.
+        slices : tuple of slices
+           The section in numpy (y,x) order.  By default the whole image is read.
+
+        Returns
+        -------
+        bucket : DataBucket
+           DataBucket with the section.
+
+        Examples
+        --------
+
+        stamp = DataBucket.read_section('mosaic.fits',1,(slice(1000,1064),slice(2000,2064)))
+
+        """
+        if os.path.exists(filename)==False:
+            raise FileNotFoundError(filename)
+        if slices is None:
+            slices = Ellipsis
+        with fits.open(filename) as hdulist:
+            if isinstance(exten,int) and exten>=len(hdulist):
+                raise IndexError('Extension number too large')
+            hdu = hdulist[exten]
+            if hdu.is_image==False:
+                raise ValueError('Sections can only be read from images')
+            data = np.array(hdusection(hdu)[slices])
+            head = sectionheader(hdu.header.copy(),slices)
+            name = head.get('extname')
+        return DataBucket(data,head,name)
         
-    def write(self,filename,overwrite=False):
+    def write(self,filename,overwrite=False,compress=None,checksum=False):
         """
         Write to a file
+
+        Parameters
+        ----------
+        filename : str
+           Output filename.
+        overwrite : bool, optional
+           Overwrite an existing file.  Default is False.
+        compress : bool, str or dict, optional
+           Tile-compress an image, see compression().  Default is no compression.
+        checksum : bool, optional
+           Add the DATASUM and CHECKSUM keywords.  Default is False.
+
+        Examples
+        --------
+
+        bucket.write('image.fits',compress={'compression_type':'RICE_1','quantize_level':16})
+
         """
         # construct HDUList
-        hdu = self.to_hdulist()
+        hdu = self.to_hdulist(compress=compress)
         # write to file
-        hdu.writeto(filename,overwrite=overwrite)
+        hdu.writeto(filename,overwrite=overwrite,checksum=checksum)
     
 class DataContainer(object):
 
-    def __init__(self,init=None):
+    def __init__(self,init=None,lazy=False,columns=None,rows=None,where=None):
 
         # how about using the asdf format directly?
+        # Ordered name->bucket mapping, and the names in order
+        #  for constant-time indexing by position
+        self._buckets = {}
         self._bucketnames = []
+        self._hdulist = None
 
         # Empty container
         if init is None:
@@ -286,23 +1097,34 @@ class DataContainer(object):
         # Input types
         # Filename
         if isinstance(init,str):
-            hdulist = fits.open(init)
-            bucketnames = self._from_hdulist(hdulist)
-            hdulist.close()
+            # Lazy, keep the memory-mapped file open and only
+            #  read the data when it is accessed
+            if lazy:
+                hdulist = fits.open(init)
+                self._from_hdulist(hdulist,lazy=True,columns=columns,rows=rows,where=where)
+                self._hdulist = hdulist
+            else:
+                hdulist = fits.open(init)
+                self._from_hdulist(hdulist,columns=columns,rows=rows,where=where)
+                hdulist.close()
             self.filename = init
-            self._bucketnames = bucketnames
         # HDUList
         elif isinstance(init,fits.HDUList):
-            bucketnames = self._from_hdulist(init)
-            self._bucketnames = bucketnames
+            self._from_hdulist(init)
         # Some data
         else:
             db = DataBucket(init)
             self.add_bucket(db)
 
-    def _from_hdulist(self,hdulist):
-        """ Create DataContainer from HDUList """
-        bucketnames = []
+    def _from_hdulist(self,hdulist,lazy=False,columns=None,rows=None,where=None):
+        """
+        Create DataContainer from HDUList
+
+        columns, rows and where select the data of the table HDUs, see
+        readtable().  columns can be a dictionary of columns for each
+        bucket name.
+        """
+        subset = columns is not None or rows is not None or where is not None
         for i in range(len(hdulist)):
             # Primary HDU is special            
             if i==0:
@@ -312,31 +1134,73 @@ class DataContainer(object):
                 name = hdulist[i].header.get('extname')
                 if name is None:
                     name = 'exten'+str(i)
-            db = DataBucket(hdulist[i].data,hdulist[i].header,name)
-            setattr(self,name,db)
-            bucketnames.append(name)
-        return bucketnames
+                # Repeated extension names, e.g. SCI with EXTVER
+                elif name in self._buckets:
+                    name += '_'+str(hdulist[i].header.get('extver',i))
+            if subset and gethdutype(hdulist[i])=='table':
+                cols = columns
+                if isinstance(columns,dict):
+                    cols = columns.get(name)
+                data = readtable(hdulist[i],cols,rows,where)
+                db = DataBucket(data,hdulist[i].header,name)
+            elif lazy:
+                db = DataBucket(header=hdulist[i].header,name=name,hdu=hdulist[i])
+            else:
+                db = DataBucket(hdulist[i].data,hdulist[i].header,name)
+            self.add_bucket(db,name)
+
+    def __getattr__(self,name):
+        """ Get buckets as attributes """
+        # Private names are never buckets, this also keeps
+        #  copy/pickle working before the mapping is set
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self._buckets[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self,name,value):
+        """ Setting a DataBucket attribute adds or replaces a bucket """
+        if isinstance(value,DataBucket) and name.startswith('_')==False:
+            if name not in self._buckets:
+                self._bucketnames.append(name)
+            self._buckets[name] = value
+        else:
+            object.__setattr__(self,name,value)
+
+    def __delattr__(self,name):
+        """ Delete buckets as attributes """
+        if name in self._buckets:
+            self.del_bucket(name)
+        else:
+            object.__delattr__(self,name)
             
     def __len__(self):
-        return self.nbuckets
+        return len(self._bucketnames)
 
-    def __setitem__(self,index,bucket):
-        # Index can be integer or str (name)
-        if isinstance(bucket,DataBucket)==False:
-            raise ValueError('Must be DataBucket')
-        if isinstance(index,int):
-            if index>=self.nbuckets:
-                raise IndexError('Index too large')
-            name = self.bucketnames[index]
-            setattr(self,name,bucket)
+    def __contains__(self,name):
+        return name in self._buckets
+
+    def _name(self,index):
+        """ Get the bucket name of an integer or string index """
+        if isinstance(index,(int,np.integer)):
+            if index>=len(self._bucketnames):
+                raise IndexError('Index is too large')
+            return self._bucketnames[index]
         elif isinstance(index,str):
-            if index in self.bucketnames:
-                setattr(self,index,bucket)
-            else:
+            if index not in self._buckets:
                 raise IndexError(str(index)+' not found')
+            return index
         else:
             raise IndexError('Index must be integer or string name')
     
+    def __setitem__(self,index,bucket):
+        # Index can be integer or str (name)
+        if isinstance(bucket,DataBucket)==False:
+            raise ValueError('Must be DataBucket')
+        self._buckets[self._name(index)] = bucket
+    
     def __getitem__(self,index):
         """
         Return a separate spectral order
@@ -345,35 +1209,26 @@ class DataContainer(object):
         2) string of bucket names
         3) slice
         """
-        if isinstance(index,int):
+        if isinstance(index,(int,np.integer)):
             if index>=self.nbuckets:
                 raise IndexError('Index is too large')
-            name = self.bucketnames[index]
-            return getattr(self,name)
+            return self._buckets[self._bucketnames[index]]
         elif isinstance(index,str):
-            if index in self.bucketnames:
-                return getattr(self,index)
+            if index in self._buckets:
+                return self._buckets[index]
             else:
                 raise ValueError(str(index)+' not found')
         elif isinstance(index,slice):
             # Return a new DataContainer with these DataBuckets
-            start1,stop1,step1 = index.indices(self.nbuckets)
-            names = self.bucketnames[index]
+            names = self._bucketnames[index]
             new = DataContainer()
             for n in names:
-                new.add_bucket(getattr(self,n).copy())
+                new.add_bucket(self._buckets[n].copy(),n)
             return new
             
     def __iter__(self):
-        self._count = 0
-        return self
-
-    def __next__(self):
-        if self._count < self.nbuckets:
-            self._count += 1    
-            return self[self._count-1]
-        else:
-            raise StopIteration
+        # Iterate over a snapshot so the container can be modified in the loop
+        return iter(list(self._buckets.values()))
 
     def __add__(self, value):
         new = self.copy()
@@ -398,26 +1253,18 @@ class DataContainer(object):
                 if self.nbuckets==0:
                     name = 'primary'
                 else:
-                    names = self.bucketnames
-                    extnum = [int(e[5:]) for e in names if e.startswith('exten')]
-                    name = 'exten'+str(np.max(extnum)+1)
+                    extnum = [int(e[5:]) for e in self._bucketnames if e.startswith('exten') and e[5:].isdigit()]
+                    name = 'exten'+str(max(extnum,default=0)+1)
                     print('Adding',name)
-        if self.index(name) != -1:
-            raise ValueError(str(hame)+' already taken')
-        setattr(self,name,bucket)
+        if name in self._buckets:
+            raise ValueError(str(name)+' already taken')
+        self._buckets[name] = bucket
         self._bucketnames.append(name)
 
     def del_bucket(self,index):
         """ Delete a bucket """
-        if isinstance(index,int)==False and isinstance(index,str)==False:
-            raise IndexError('Index must be integer or string name')
-        if isinstance(index,int):
-            if index>=self.nbuckets:
-                raise IndexError('Index is too large')
-            name = self.bucketnames[index]
-        else:
-            name = index
-        delattr(self,name)
+        name = self._name(index)
+        del self._buckets[name]
         self._bucketnames.remove(name)
         
     @property
@@ -440,39 +1287,23 @@ class DataContainer(object):
     @property
     def bucketnames(self):
         """ Return the names of all the data buckets """
-        # check _bucketnames and add any others in alphabetical order
-        names = self._bucketnames.copy()
-        nnames = len(names)
-        ignore = names+['bucketnames','nbuckets','buckets','data','meta']
-        for d in dir(self):
-            if d in ignore or d[0]=='_': continue
-            if isinstance(getattr(self,d),DataBucket):
-                names.append(d)
-        if len(names)>nnames:
-            self._bucketnames = names  # update
-        return names
+        return list(self._bucketnames)
 
     @property
     def nbuckets(self):
-        return len(self.bucketnames)
+        return len(self._bucketnames)
     
     @property
     def buckets(self):
-        """ Return the names of all the data buckets """
-        # We need to check every time since someone might
-        # have added a new one
-        out = []
-        for d in self.bucketnames:
-            out.append(getattr(self,d))
-        return out
+        """ Return all the data buckets """
+        return list(self._buckets.values())
 
     def index(self,name):
         # Get bucket index by name
-        index, = np.where(self.bucketnames == name)
-        if len(index)==0:
+        if name not in self._buckets:
             return -1
         else:
-            return index[0]
+            return self._bucketnames.index(name)
         
     def __repr__(self):
         """ Represent the data """
@@ -501,33 +1332,140 @@ class DataContainer(object):
         for n in self.bucketnames:
             self[n].info()
 
-    def copy(self):
-        """ Make a copy """
-        return copy.deepcopy(self)
+    def copy(self,deep=True):
+        """
+        Make a copy
+
+        By default this is a full copy.  With deep=False the buckets
+        share their data with the copy until they are changed
+        (copy-on-write), see DataBucket.copy().
+        """
+        new = DataContainer()
+        for n in self.bucketnames:
+            new.add_bucket(self[n].copy(deep=deep),n)
+        if hasattr(self,'filename'):
+            new.filename = self.filename
+        return new
+
+    def close(self):
+        """ Close the file of a lazy container """
+        if self._hdulist is not None:
+            # Attach any data that hasn't been loaded yet,
+            #  memory-mapped arrays stay valid after closing
+            for d in self.buckets:
+                d.load()
+            self._hdulist.close()
+            self._hdulist = None
+    
+    def _compression(self,compress):
+        """ Get the compression setting of each bucket """
+        # Dictionary of per-bucket settings
+        if isinstance(compress,dict) and any([k in self._buckets for k in compress]):
+            return {n:compress.get(n) for n in self._bucketnames}
+        return {n:compress for n in self._bucketnames}
+    
+    def _hdubuckets(self,compress=None):
+        """
+        Return (bucket,primary,compress) for each HDU, a None bucket
+        is an empty primary HDU
+        """
+        settings = self._compression(compress)
+        out = []
+        for i,n in enumerate(self._bucketnames):
+            d = self._buckets[n]
+            comp = settings[n]
+            if d.datatype!='ndarray':
+                comp = None
+            if i==0:
+                # Tables and compressed images need an empty primary HDU in front
+                if d.datatype=='table' or compression(comp) is not None:
+                    out.append((None,True,None))
+                else:
+                    out.append((d,True,None))
+                    continue
+            out.append((d,False,comp))
+        return out
     
-    def to_hdulist(self):
+    def to_hdulist(self,compress=None):
         """ Make a HDUList """
         hdu = fits.HDUList()
-        hdu.append(fits.PrimaryHDU(self.data,self.header))
         # Get DataBuckets
-        for d in self.buckets:
-            hdu.append(d.to_hdulist())
+        for d,primary,comp in self._hdubuckets(compress):
+            if d is None:
+                hdu.append(fits.PrimaryHDU())
+            else:
+                hdu.append(d.to_hdulist(primary=primary,compress=comp))
         return hdu
     
     @classmethod
-    def read(cls,filename):
+    def read(cls,filename,lazy=False,columns=None,rows=None,where=None):
         """
         Read a file
+
+        columns, rows and where only read some of the data of the
+        tables, see readtable().
         """
         if os.path.exists(filename)==False:
             raise FileNotFoundError(filename)
-        return DataContainer(filename)
+        return DataContainer(filename,lazy=lazy,columns=columns,rows=rows,where=where)
         
-    def write(self,filename,overwrite=False):
+    def write(self,filename,overwrite=False,compress=None,checksum=False,nthreads=4):
         """
         Write to a file
+
+        The HDUs are built and serialized in a thread pool and streamed
+        to the file in order, so only about nthreads buckets are held in
+        memory in their serialized form at any time.
+
+        Parameters
+        ----------
+        filename : str
+           Output filename.  Files ending in .gz are gzipped.
+        overwrite : bool, optional
+           Overwrite an existing file.  Default is False.
+        compress : bool, str or dict, optional
+           Tile-compress the images, see compression().  This can also be a
+             dictionary of settings for each bucket name, e.g. from the
+             datamodel.  Default is no compression.
+        checksum : bool, optional
+           Add the DATASUM and CHECKSUM keywords.  Default is False.
+        nthreads : int, optional
+           Number of threads to build and compress the HDUs with.  Default is 4.
+
+        Examples
+        --------
+
+        dc.write('reduced.fits',overwrite=True)
+        dc.write('reduced.fits',compress={'sci':{'compression_type':'RICE_1','quantize_level':16},
+                                          'mask':'PLIO_1'},checksum=True)
+
         """
-        # construct a HDUList object
-        hdulist = self.to_hdulist()
-        # write to file
-        hdulist.writeto(filename,overwrite=overwrite)
+        if os.path.exists(filename) and overwrite==False:
+            raise OSError(filename+' already exists')
+        def serialize(d,primary,comp):
+            if d is None:
+                return hdubytes(fits.PrimaryHDU(),primary=True,checksum=checksum)
+            return hdubytes(d.to_hdulist(primary=primary,compress=comp),
+                            primary=primary,checksum=checksum)
+        # Write to a temporary file so a failure never leaves a partial file
+        tempfile = filename+'.'+str(os.getpid())+'.tmp'
+        # Gzip the output like astropy does for .gz filenames
+        if filename.endswith('.gz'):
+            fopen = gzip.open
+        else:
+            fopen = open
+        try:
+            with fopen(tempfile,'wb') as f, ThreadPoolExecutor(max_workers=max(nthreads,1)) as executor:
+                pending = []
+                for d,primary,comp in self._hdubuckets(compress):
+                    pending.append(executor.submit(serialize,d,primary,comp))
+                    # Limit the number of serialized HDUs waiting to be written
+                    if len(pending)>=max(nthreads,1):
+                        f.write(pending.pop(0).result())
+                for p in pending:
+                    f.write(p.result())
+            os.replace(tempfile,filename)
+        except:
+            if os.path.exists(tempfile):
+                os.remove(tempfile)
+            raise
@@ -4,6 +4,11 @@ import time
 import tempfile
 import subprocess
 import sqlite3
+import threading
+import weakref
+from functools import wraps
+from urllib.request import pathname2url
+from concurrent.futures import ThreadPoolExecutor
 #import psycopg2 as pg
 #from psycopg2.extras import execute_values
 from astropy.table import Table
@@ -114,7 +119,7 @@ def getblob(dbfile,key,column='blob',table='blobname'):
     db.close()
     return data
             
-def opendb(dbfile):
+def opendb(dbfile,readonly=False,check_same_thread=True):
     """ Open database and add adapters """
     sqlite3.register_adapter(np.int8, int)
     sqlite3.register_adapter(np.int16, int)
@@ -123,9 +128,58 @@ def opendb(dbfile):
     sqlite3.register_adapter(np.float16, float)
     sqlite3.register_adapter(np.float32, float)
     sqlite3.register_adapter(np.float64, float)
-    db = sqlite3.connect(dbfile, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+    # Read-only connection
+    if readonly:
+        uri = 'file:'+pathname2url(os.path.abspath(dbfile))+'?mode=ro'
+        db = sqlite3.connect(uri, uri=True, check_same_thread=check_same_thread,
+                             detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+    else:
+        db = sqlite3.connect(dbfile, check_same_thread=check_same_thread,
+                             detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
     return db
 
+def _table_rows(data,chunksize=100000):
+    """
+    Generator of row tuples from a table or structured array.
+
+    The rows are created from the column buffers one chunk at a time,
+    so only chunksize rows are ever converted to Python objects.
+
+    Parameters
+    ----------
+    data : astropy Table or numpy structured array
+       The table.
+    chunksize : int, optional
+       Number of rows to convert at a time.  Default is 100000.
+
+    Returns
+    -------
+    Generator that yields a tuple for each row.
+
+    Examples
+    --------
+
+    cur.executemany(sql,_table_rows(tab))
+
+    """
+    if isinstance(data,Table):
+        names = data.colnames
+    else:
+        names = data.dtype.names
+    nrows = len(data)
+    for i in range(0,nrows,chunksize):
+        columns = []
+        for n in names:
+            # slice of the column is a view, no copy
+            col = data[n][i:i+chunksize]
+            # sqlite3 needs Python types, decode bytes to str
+            if col.dtype.kind == 'S':
+                col = np.char.decode(col)
+            columns.append(col.tolist())
+        for row in zip(*columns):
+            yield row
+        del columns
+            
 def writetab(tab,dbfile,table='meas'):
     """ Write a catalog to the database """
     ncat = dln.size(tab)
@@ -133,11 +187,16 @@ def writetab(tab,dbfile,table='meas'):
     c = db.cursor()
 
     # Convert numpy data types to sqlite3 data types
-    d2d = {"S":"TEXT", "i":"INTEGER", "f":"REAL"}
+    d2d = {"S":"TEXT", "U":"TEXT", "i":"INTEGER", "u":"INTEGER",
+           "b":"INTEGER", "f":"REAL"}
 
     # Get the column names
-    cnames = tab.dtype.names
-    cdict = dict(tab.dtype.fields)
+    if isinstance(tab,Table):
+        cnames = tab.colnames
+        cdict = {n:(tab[n].dtype,) for n in cnames}
+    else:
+        cnames = tab.dtype.names
+        cdict = dict(tab.dtype.fields)
     # Create the table
     #   the primary key ROWID is automatically generated
     if len(c.execute('SELECT name from sqlite_master where type= "table" and name="'+table+'"').fetchall()) < 1:
@@ -148,7 +207,7 @@ def writetab(tab,dbfile,table='meas'):
     columns = []
     for n in cnames: columns.append(n.lower())
     qmarks = np.repeat('?',dln.size(cnames))
-    c.executemany('INSERT INTO '+table+'('+','.join(columns)+') VALUES('+','.join(qmarks)+')', list(tab))
+    c.executemany('INSERT INTO '+table+'('+','.join(columns)+') VALUES('+','.join(qmarks)+')', _table_rows(tab))
     db.commit()
     db.close()
 
@@ -192,8 +251,336 @@ def analyzetable(dbfile,table,verbose=False):
     #db.close()
     if verbose: print('analyzing done after '+str(time.time()-t0)+' sec')
     
+def _blob_array(values):
+    """ Put a column with BLOB values into an object array of bytes."""
+    # numpy 'S' arrays strip trailing null bytes, so BLOBs are kept
+    #  as bytes objects
+    arr = np.empty(len(values),dtype=object)
+    arr[:] = [bytes(v) if isinstance(v,memoryview) else v for v in values]
+    return arr
+
+def _column_array(values):
+    """ Convert a column of values returned by sqlite3 into a numpy array."""
+    if any([isinstance(v,(bytes,memoryview)) for v in values]):
+        return _blob_array(values)
+    arr = np.array(values)
+    if arr.dtype.kind != 'O':
+        return arr
+    # Deal with NULL values, use NaN for numbers and '' for text
+    good = [v for v in values if v is not None]
+    if len(good)==0 or len(good)==len(values):
+        return arr
+    if all([isinstance(v,(int,float)) for v in good]):
+        return np.array([np.nan if v is None else v for v in values],float)
+    if all([isinstance(v,str) for v in good]):
+        return np.array(['' if v is None else v for v in values])
+    return arr
+
+def _concat_columns(arrays):
+    """ Concatenate the chunks of a column."""
+    if len(arrays)==1:
+        return arrays[0]
+    # Chunks that are all NULL get the type of the other chunks
+    kinds = [a.dtype.kind for a in arrays if a.dtype.kind != 'O']
+    if len(kinds)>0 and len(kinds)<len(arrays):
+        allnull = [a.dtype.kind=='O' and all([v is None for v in a]) for a in arrays]
+        if np.sum(allnull)+len(kinds)==len(arrays):
+            if all([k in 'iuf' for k in kinds]):
+                fill = np.nan
+            elif all([k=='U' for k in kinds]):
+                fill = ''
+            else:
+                fill = None
+            if fill is not None:
+                arrays = [np.full(len(a),fill) if isnull else a
+                          for a,isnull in zip(arrays,allnull)]
+    return np.concatenate(arrays)
+
+def _fetch_columnar(cur,chunksize=100000):
+    """
+    Fetch the results of an executed query into a numpy structured array.
+
+    The rows are fetched in chunks with fetchmany() and transposed into
+    per-column numpy arrays, so the full list of tuples is never held in
+    memory.  String columns are sized from the data.
+
+    Parameters
+    ----------
+    cur : sqlite3.Cursor
+       Cursor with an executed query.
+    chunksize : int, optional
+       Number of rows to fetch at a time.  Default is 100000.
+
+    Returns
+    -------
+    tab : numpy structured array
+       The query results.  An empty array if there are no results.
+
+    Examples
+    --------
+
+    cur.execute('SELECT * FROM meas')
+    tab = _fetch_columnar(cur)
+
+    """
+    # Statements that do not return rows (INSERT, UPDATE, ...)
+    if cur.description is None:
+        return np.array([])
+    names = [d[0] for d in cur.description]
+    columns = [[] for n in names]
+    nrows = 0
+    while True:
+        rows = cur.fetchmany(chunksize)
+        if len(rows)==0:
+            break
+        nrows += len(rows)
+        for i,values in enumerate(zip(*rows)):
+            columns[i].append(_column_array(values))
+        del rows
+    # No results
+    if nrows==0:
+        return np.array([])
+    # Concatenate the chunks
+    for i in range(len(names)):
+        columns[i] = _concat_columns(columns[i])
+    dtype = np.dtype([(n,c.dtype) for n,c in zip(names,columns)])
+    tab = np.zeros(nrows,dtype=dtype)
+    for i,n in enumerate(names):
+        tab[n] = columns[i]
+        columns[i] = None   # free the memory
+    return tab
+    
+def _chunk_to_array(names,rows):
+    """ Convert a chunk of rows into a numpy structured array."""
+    columns = [_column_array(values) for values in zip(*rows)]
+    dtype = np.dtype([(n,c.dtype) for n,c in zip(names,columns)])
+    tab = np.zeros(len(rows),dtype=dtype)
+    for n,c in zip(names,columns):
+        tab[n] = c
+    return tab
+
+# Value types of the exported columns
+_exporttypes = [(int,'int'),(float,'float'),(str,'text'),(bytes,'blob')]
+
+def _encode_column(values,prefix):
+    """
+    Encode a column of sqlite3 values as arrays that can be saved without pickle.
+
+    NULLs are kept in a boolean PREFIX_null mask and the values of each type
+    in a typed array (PREFIX_int, PREFIX_float, PREFIX_text, or PREFIX_blob
+    with the concatenated bytes and PREFIX_bloblen with their lengths).
+    Columns with more than one type of value also get a PREFIX_type array
+    with the type code (index in _exporttypes) of every row.
+    """
+    out = {}
+    codes = np.full(len(values),-1,np.int8)
+    for i,v in enumerate(values):
+        if v is None:
+            continue
+        for j,(typ,name) in enumerate(_exporttypes):
+            if isinstance(v,typ):
+                codes[i] = j
+                break
+    null = (codes==-1)
+    if np.sum(null)>0:
+        out[prefix+'_null'] = null
+    present = np.unique(codes[~null])
+    if len(present)>1:
+        out[prefix+'_type'] = codes
+    for j in present:
+        typ,name = _exporttypes[j]
+        vals = [values[i] for i in np.where(codes==j)[0]]
+        if name=='blob':
+            out[prefix+'_blob'] = np.frombuffer(b''.join(vals),np.uint8)
+            out[prefix+'_bloblen'] = np.array([len(v) for v in vals],np.int64)
+        elif name=='text':
+            out[prefix+'_text'] = np.array(vals,dtype=str)
+        else:
+            out[prefix+'_'+name] = np.array(vals,dtype=typ)
+    return out
+
+def _decode_column(npz,prefix,nrows):
+    """ Decode a column that was encoded with _encode_column()."""
+    null = npz[prefix+'_null'] if prefix+'_null' in npz else np.zeros(nrows,bool)
+    if prefix+'_type' in npz:
+        codes = npz[prefix+'_type']
+    else:
+        codes = np.zeros(nrows,np.int8)
+        for j,(typ,name) in enumerate(_exporttypes):
+            if prefix+'_'+name in npz:
+                codes[:] = j
+        codes[null] = -1
+    arrays = {}
+    for j,(typ,name) in enumerate(_exporttypes):
+        if prefix+'_'+name not in npz:
+            continue
+        if name=='blob':
+            buf = npz[prefix+'_blob'].tobytes()
+            lens = npz[prefix+'_bloblen']
+            offsets = np.concatenate(([0],np.cumsum(lens)))
+            arrays[j] = [buf[offsets[k]:offsets[k+1]] for k in range(len(lens))]
+        else:
+            arrays[j] = npz[prefix+'_'+name]
+    # A single type of value and no NULLs keeps the typed array
+    if len(arrays)==1 and np.sum(null)==0 and _exporttypes[list(arrays)[0]][1]!='blob':
+        return list(arrays.values())[0]
+    col = np.empty(nrows,dtype=object)
+    for j,arr in arrays.items():
+        ind = np.where(codes==j)[0]
+        if isinstance(arr,np.ndarray):
+            arr = arr.tolist()
+        for k,i in enumerate(ind):
+            col[i] = arr[k]
+    return col
+
+def _declared_dtypes(db,table,names):
+    """
+    Starting dtypes of the query columns from the declared column types
+    of a table.  None is used for columns with no usable declared type.
+    """
+    try:
+        info = db.execute('PRAGMA table_info("'+table+'")').fetchall()
+    except sqlite3.Error:
+        return [None for n in names]
+    declared = {r[1]:r[2].upper() for r in info}
+    dtypes = []
+    for n in names:
+        # Use the sqlite type affinity rules
+        typ = declared.get(n,'')
+        if typ.find('INT')>-1:
+            dt = np.dtype(np.int64)
+        elif any([typ.find(t)>-1 for t in ['CHAR','CLOB','TEXT']]):
+            dt = np.dtype('U1')
+        elif typ.find('BLOB')>-1:
+            dt = np.dtype(object)
+        elif any([typ.find(t)>-1 for t in ['REAL','FLOA','DOUB']]):
+            dt = np.dtype(float)
+        else:
+            dt = None
+        dtypes.append(dt)
+    return dtypes
+
+def _widen_dtype(dt,arr):
+    """ Widen a column dtype so it can hold the values of a new chunk."""
+    # All NULL, numbers use NaN
+    if arr.dtype.kind=='O' and all([v is None for v in arr]):
+        if dt is None or dt.kind in 'iub':
+            return np.dtype(float)
+        return dt
+    if dt is None:
+        return arr.dtype
+    if dt.kind=='O' or arr.dtype.kind=='O':
+        return np.dtype(object)
+    if dt.kind in 'iubf' and arr.dtype.kind in 'iubf':
+        return np.promote_types(dt,arr.dtype)
+    if dt.kind=='U' and arr.dtype.kind=='U':
+        return max(dt,arr.dtype,key=lambda d:d.itemsize)
+    # Mixed text and numbers
+    return np.dtype(object)
+
+def _chunk_to_dtype(names,rows,dtypes):
+    """
+    Convert a chunk of rows into a numpy structured array.  The column
+    dtypes (updated in place) are widened as needed, but never narrowed.
+    """
+    columns = []
+    for i,values in enumerate(zip(*rows)):
+        arr = _column_array(values)
+        dt = _widen_dtype(dtypes[i],arr)
+        dtypes[i] = dt
+        # Keep the values as they are, numpy would turn mixed values into strings
+        if dt.kind=='O':
+            arr = np.empty(len(values),dtype=object)
+            arr[:] = values
+        # This chunk is all NULL
+        elif arr.dtype.kind=='O':
+            arr = np.full(len(values),np.nan if dt.kind=='f' else '',dtype=dt)
+        columns.append(arr)
+    tab = np.zeros(len(rows),dtype=np.dtype([(n,dt) for n,dt in zip(names,dtypes)]))
+    for n,c in zip(names,columns):
+        tab[n] = c
+    return tab
+
+def iterquery(dbfile,sql=None,table=None,cols='*',where=None,chunksize=100000,
+              astable=False,verbose=False):
+    """
+    Iterate over the results of a query in chunks.
+
+    Parameters
+    ----------
+    dbfile : str or sqlite3.Connection
+       Database filename or connection.
+    sql : str, optional
+       The SQL SELECT statement.  Either sql or table must be input.
+    table : str, optional
+       Name of the table to query.
+    cols : str, optional
+       Comma-separated list of columns to return.  Default is all columns.
+    where : str, optional
+       WHERE condition.
+    chunksize : int, optional
+       Number of rows per chunk.  Default is 100000.
+    astable : bool, optional
+       Return astropy Tables instead of numpy structured arrays.  Default is False.
+    verbose : bool, optional
+       Verbose output.  Default is False.
+
+    Returns
+    -------
+    Generator that yields numpy structured arrays or astropy Tables with
+      up to chunksize rows.  The dtypes of the columns start from the
+      declared column types (or the first chunk) and are only widened
+      in later chunks, e.g. integers to floats when NULLs appear or
+      to longer strings.
+
+    Examples
+    --------
+
+    for tab in iterquery(dbfile,table='meas',chunksize=1000000):
+        process(tab)
+
+    """
+    if isinstance(dbfile,str):
+        db = opendb(dbfile)
+    elif isinstance(dbfile,sqlite3.Connection):
+        db = dbfile
+    else:
+        raise ValueError('dbfile input not supported')
+    if sql is None:
+        if table is None:
+            raise ValueError('Need sql or table for query')
+        sql = 'SELECT '+cols+' FROM '+table
+        if where is not None:
+            sql += ' WHERE '+where
+    if verbose:
+        print('CMD = '+sql)
+    # Use a separate cursor so other queries can be run while iterating
+    cur = db.cursor()
+    try:
+        cur.execute(sql)
+        names = [d[0] for d in cur.description]
+        # The column dtypes start from the declared types and
+        #  are widened as the chunks come in
+        if table is not None:
+            dtypes = _declared_dtypes(db,table,names)
+        else:
+            dtypes = [None for n in names]
+        while True:
+            rows = cur.fetchmany(chunksize)
+            if len(rows)==0:
+                break
+            tab = _chunk_to_dtype(names,rows,dtypes)
+            del rows
+            if astable:
+                tab = Table(tab)
+            yield tab
+    finally:
+        cur.close()
+        if isinstance(dbfile,str):
+            db.close()
+            
 def query(dbfile,table='registry',cols='*',where=None,raw=False,
-          groupby=None,limit=None,verbose=False):
+          groupby=None,limit=None,chunksize=100000,verbose=False):
     """ Get rows from the database """
     t0 = time.time()
     if isinstance(dbfile,str):
@@ -204,10 +591,6 @@ def query(dbfile,table='registry',cols='*',where=None,raw=False,
         raise RaiseValue('dbfile input not supported')
     cur = db.cursor()
 
-    # Convert numpy data types to sqlite3 data types
-    d2d = {"TEXT":(str,200), "INTEGER":int,
-           "REAL":float, "BLOB":object}
-
     # Start the SELECT statement
     cmd = 'SELECT '+cols+' FROM '+table
     # Add WHERE statement
@@ -224,46 +607,24 @@ def query(dbfile,table='registry',cols='*',where=None,raw=False,
     if verbose:
         print('CMD = '+cmd)
     cur.execute(cmd)
-    data = cur.fetchall()
-
-    # No results
-    if len(data)==0:
-        return np.array([])
 
     # Return the raw results
     if raw is True:
+        data = cur.fetchall()
+        # No results
+        if len(data)==0:
+            return np.array([])
         return data
-    
-    # Get table column names and data types
-    cur.execute("select sql from sqlite_master where tbl_name = '"+table+"' and type='table'")
-    res = cur.fetchall()
-    #db.close()
-    head = res[0][0]
-    # 'CREATE TABLE exposure(expnum TEXT, nchips INTEGER, filter TEXT, exptime REAL, utdate TEXT, uttime TEXT, airmass REAL, wcstype TEXT)'
-    lo = head.find('(')
-    hi = head.find(')')
-    head = head[lo+1:hi]
-    columns = head.split(',')
-    columns = dln.strip(columns)
-    dt = []
-    for c in columns:
-        pair = c.split(' ')
-        # no data type, default is blob
-        if len(pair)==1:
-            pair.append('blob')
-        dt.append( (pair[0], d2d[pair[1].upper()]) )
-    dtype = np.dtype(dt)
 
     # Convert to numpy structured array
-    tab = np.zeros(len(data),dtype=dtype)
-    tab[...] = data
-    del(data)
-
+    tab = _fetch_columnar(cur,chunksize=chunksize)
+    cur.close()
+    
     if verbose: print('got data in '+str(time.time()-t0)+' sec.')
 
     return tab
 
-def data_standardize(data,table_columns):
+def data_standardize(data,table_columns,stream=False):
     """
     Standardize data to insert/update database.
 
@@ -279,6 +640,12 @@ def data_standardize(data,table_columns):
       3) list/tuple: must have the correct number of columns
            and in the right order.  Can also input list of lists
            to insert multiple rows at one time.
+    table_columns : list
+      List of the database table column names.
+    stream : bool, optional
+      Return a generator of row tuples for table input instead of a list.
+        The rows are then created from the column buffers one chunk at
+        a time.  Default is False.
 
     Returns
     -------
@@ -300,6 +667,14 @@ def data_standardize(data,table_columns):
     # 1) Table
     #---------
     if isinstance(data,Table) or (isinstance(data,np.ndarray) and data.dtype.names is not None):
+        # Stream the rows from the column buffers
+        if stream:
+            data_tuple = _table_rows(data)
+            if isinstance(data,Table):
+                cols = data.colnames
+            else:
+                cols = data.dtype.names
+            return data_tuple,cols
         # Convert astropy table to numpy structured array table
         if isinstance(data,Table):
             data = np.array(data)
@@ -345,13 +720,80 @@ def data_standardize(data,table_columns):
     return data_tuple,cols
     
     
+def serialized(func):
+    """ Run a Database method on the writer thread in pooled mode."""
+    @wraps(func)
+    def wrapper(self,*args,**kwargs):
+        if getattr(self,'pool',False) and getattr(self._local,'writer',False)==False:
+            return self._writerexecutor().submit(func,self,*args,**kwargs).result()
+        return func(self,*args,**kwargs)
+    return wrapper
+
+
+def _closepooled(dbref,db):
+    """ Close a pooled connection, e.g. when its thread has exited."""
+    database = dbref()
+    if database is not None:
+        with database._poollock:
+            if db in database._connections:
+                database._connections.remove(db)
+    db.close()
+
+
+class _ThreadConnection(object):
+    """ Connection and cursor of one thread in pooled mode """
+
+    __slots__ = ('db','cur','generation','release','__weakref__')
+
+    
 class Database(object):
     """
     Jeeves database object
+
+    Parameters
+    ----------
+    filename : str, optional
+       Database filename.  Default is ':memory:'.
+    pool : bool, optional
+       Pooled mode for use from multiple threads.  Every thread gets its own
+         read-only connection and the database is put in WAL mode so readers
+         run concurrently.  All writes are serialized through a queue that is
+         run by a single writer thread.  Default is False.
+
     """
 
-    def __init__(self,filename=':memory:'):
+    def __init__(self,filename=':memory:',pool=False):
         self.filename = filename
+        self.pool = pool
+        self._db = None
+        self._cur = None
+        self._schemacache = None
+        self._schemalock = threading.RLock()
+        if pool:
+            if filename is None or filename==':memory:':
+                raise ValueError('Pooled mode needs a database file')
+            self._local = threading.local()
+            self._connections = []
+            self._generation = 0
+            self._poollock = threading.Lock()
+            # Readers can run concurrently with the writer in WAL mode
+            db = opendb(filename)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.close()
+            # Writer queue with a single thread, started on first use
+            self._writer = None
+
+    def _writerexecutor(self):
+        """ Return the writer queue (pooled mode)."""
+        with self._poollock:
+            if self._writer is None:
+                self._writer = ThreadPoolExecutor(max_workers=1,initializer=self._initwriter,
+                                                  thread_name_prefix='jeeves-writer')
+            return self._writer
+
+    def _initwriter(self):
+        """ Mark the writer thread."""
+        self._local.writer = True
 
     def __repr__(self):
         """ Print info """
@@ -377,15 +819,60 @@ class Database(object):
         """ Open the database for reading/writing."""
         if self.filename is None:
             raise ValueError('No database filename')
+        if self.pool:
+            self._poolconnection()
+            return
         if self._db is None:
             self._db = opendb(self.filename)
+
+    def _poolconnection(self):
+        """ Return the connection and cursor of this thread (pooled mode)."""
+        conn = getattr(self._local,'conn',None)
+        if conn is None or conn.generation != self._generation:
+            # The writer thread gets the only read/write connection
+            readonly = getattr(self._local,'writer',False)==False
+            db = opendb(self.filename,readonly=readonly,check_same_thread=False)
+            conn = _ThreadConnection()
+            conn.db = db
+            conn.cur = db.cursor()
+            conn.generation = self._generation
+            # The connection is closed when the thread exits and
+            #  its local data is removed
+            conn.release = weakref.finalize(conn,_closepooled,weakref.ref(self),db)
+            with self._poollock:
+                self._connections.append(db)
+            self._local.conn = conn
+        return conn.db,conn.cur
+
+    def _releaseconnection(self):
+        """ Close the connection of this thread (pooled mode)."""
+        conn = getattr(self._local,'conn',None)
+        if conn is None:
+            return
+        self._local.conn = None
+        conn.release()
         
     def close(self):
         """ Close the database."""
-        if self._db is not None:
-            if self.cur is not None:
-                self.cur.close()  # close cursor first
+        if self.pool:
+            # Stop the writer thread, it is restarted if the database is used again
+            with self._poollock:
+                writer,self._writer = self._writer,None
+            if writer is not None:
+                writer.shutdown(wait=getattr(self._local,'writer',False)==False)
+            # Close the connections of all threads
+            with self._poollock:
+                for db in self._connections:
+                    db.close()
+                self._connections = []
+                self._generation += 1
+        elif self._db is not None:
+            if self._cur is not None:
+                self._cur.close()  # close cursor first
+                self._cur = None
             self._db.close()
+            self._db = None
+        self._clearschema()
 
     def size(self,name=None):
         """ Return size of database or table."""
@@ -393,13 +880,13 @@ class Database(object):
         # Database
         if name is None:
             sql = 'SELECT name, SUM("pgsize") FROM "dbstat" GROUP BY name'
-            res = self.query(sql=sql)
+            res = self.query(sql=sql,raw=True)
         # Table
         else:
             sql = 'SELECT name, SUM("pgsize") FROM "dbstat"'
             sql += " WHERE name='"+name+"'"
             sql += " GROUP BY name"
-            res = self.query(sql=sql)
+            res = self.query(sql=sql,raw=True)
         sz = [r[1] for r in res if r[0]!='sqlite_schema']
         if len(sz)==0:
             return None
@@ -409,6 +896,8 @@ class Database(object):
     @property
     def db(self):
         """ Return the db object."""
+        if self.pool:
+            return self._poolconnection()[0]
         if hasattr(self,'_db')==False:
             self._db = None
         if self._db is None:
@@ -418,6 +907,8 @@ class Database(object):
     @property
     def cur(self):
         """ Return the cursor object."""
+        if self.pool:
+            return self._poolconnection()[1]
         # No cursor, create it
         if hasattr(self,'_cur')==False:
             self._cur = None
@@ -425,6 +916,30 @@ class Database(object):
             self._cur = self.db.cursor()
         return self._cur
 
+    def _tableinfo(self):
+        """ Return the cached table names, column names and declared types."""
+        with self._schemalock:
+            if self._schemacache is None:
+                info = {}
+                cur = self.cur
+                cur.execute("select name from sqlite_master where type='table'")
+                tables = [r[0] for r in cur.fetchall()]
+                for t in tables:
+                    cur.execute("PRAGMA table_info('"+t+"')")
+                    info[t] = [(r[1],r[2]) for r in cur.fetchall()]
+                self._schemacache = info
+            return self._schemacache
+
+    def _clearschema(self):
+        """ Clear the cached table schema."""
+        with self._schemalock:
+            self._schemacache = None
+        
+    def refresh_schema(self):
+        """ Reload the cached table schema."""
+        self._clearschema()
+        self._tableinfo()
+    
     def schema(self,table=None):
         """ Return the schema."""
         res = []
@@ -441,13 +956,17 @@ class Database(object):
         return res
         
     def query(self,sql=None,table=None,cols='*',where=None,
-              raw=False,groupby=None,limit=None,verbose=False):
+              raw=False,groupby=None,limit=None,chunksize=100000,verbose=False):
         """ Run a query."""
         # SQL text input
         if sql is not None:
             self.cur.execute(sql)
-            res = self.cur.fetchall()
-            return res
+            # Return the raw results, statements that do not
+            #  return rows give an empty list
+            if raw or self.cur.description is None:
+                res = self.cur.fetchall()
+                return res
+            return _fetch_columnar(self.cur,chunksize=chunksize)
         # Separated information input
         else:
             if table is None:
@@ -455,8 +974,52 @@ class Database(object):
             if self.exists(table)==False:
                 raise ValueError(str(table)+' table does not exist')
             return query(self.db,table=table,cols=cols,where=where,raw=raw,
-                         groupby=groupby,limit=limit,verbose=verbose)
+                         groupby=groupby,limit=limit,chunksize=chunksize,
+                         verbose=verbose)
+
+    def iterquery(self,sql_or_table,cols='*',where=None,chunksize=100000,
+                  astable=False,verbose=False):
+        """
+        Iterate over the results of a query in chunks.
+
+        Parameters
+        ----------
+        sql_or_table : str
+           SQL SELECT statement or the name of a table.
+        cols : str, optional
+           Comma-separated list of columns to return for a table.  Default is all columns.
+        where : str, optional
+           WHERE condition for a table.
+        chunksize : int, optional
+           Number of rows per chunk.  Default is 100000.
+        astable : bool, optional
+           Return astropy Tables instead of numpy structured arrays.  Default is False.
+        verbose : bool, optional
+           Verbose output.  Default is False.
+
+        Returns
+        -------
+        Generator that yields numpy structured arrays or astropy Tables with
+          up to chunksize rows.  The dtypes of the columns start from the
+          declared column types (or the first chunk) and are only widened
+          in later chunks, see iterquery().
 
+        Examples
+        --------
+
+        for tab in db.iterquery('meas',chunksize=1000000):
+            process(tab)
+
+        """
+        if len(sql_or_table.split())==1:
+            if self.exists(sql_or_table)==False:
+                raise ValueError(str(sql_or_table)+' table does not exist')
+            return iterquery(self.db,table=sql_or_table,cols=cols,where=where,
+                             chunksize=chunksize,astable=astable,verbose=verbose)
+        return iterquery(self.db,sql=sql_or_table,chunksize=chunksize,
+                         astable=astable,verbose=verbose)
+        
+    @serialized
     def insert(self,table,data,onconflict=None,constraintname=None):
         """
         Insert information into a table.
@@ -502,7 +1065,7 @@ class Database(object):
             raise ValueError('table '+str(table)+' not found')
         # Standardize the data input
         table_columns = self.columns(table)
-        data_tuple,cols = data_standardize(data,table_columns)
+        data_tuple,cols = data_standardize(data,table_columns,stream=True)
         
         # Given values for some of the columns
         # INSERT INTO table_name (column1, column2, column3, ...)
@@ -526,97 +1089,137 @@ class Database(object):
             sql += ' ON CONFLICT '+onconflict
             if onconflict.lower()=='update' and updateset is not None:
                 sql += ' SET '+updateset
-        if len(data_tuple)==1:
+        if isinstance(data_tuple,list) and len(data_tuple)==1:
             self.cur.execute(sql, data_tuple[0])
         else:
             self.cur.executemany(sql, data_tuple)
         self.db.commit()
 
-    def update(self,table,data,condition):
-        """ Update database."""
-        vals = table.split('.')
-        if len(vals)==1:
-            raise ValueError('')
+    @serialized
+    def update(self,table,data,condition=None,keys=None):
+        """
+        Update rows in a table.
+
+        Parameters
+        ----------
+        table : str
+           Name of the table.
+        data : 
+           Data with the new values.  Same formats as for insert().
+        condition : str or list, optional
+           WHERE condition for each row of data, or a single condition
+             for all of them.
+        keys : str or list, optional
+           Name(s) of the key columns in data to match rows on.  The new values
+             are staged in a temporary table and applied with a single
+             set-based UPDATE.  Either condition or keys must be input.
+
+        Examples
+        --------
+
+        update('meas',data,keys='measid')
+
+        update('meas',{'flag':1},"measid='abc'")
+
+        """
         # Check that the table exists
         if self.exists(table)==False:
             raise ValueError('table '+str(table)+' not found')
+        if condition is None and keys is None:
+            raise ValueError('Need condition or keys')
 
         table_columns = self.columns(table)
         data_tuple,cols = data_standardize(data,table_columns)
+        cols = list(cols)
         
         # UPDATE table_name
         # SET column1 = value1, column2 = value2, ...
         # WHERE condition;
 
+        # Bulk update on key columns
+        if keys is not None:
+            if isinstance(keys,str):
+                keys = [keys]
+            for k in keys:
+                if k not in cols:
+                    raise ValueError('key '+str(k)+' not in data')
+            setcols = [c for c in cols if c not in keys]
+            try:
+                # UPDATE ... FROM needs sqlite 3.33
+                if sqlite3.sqlite_version_info >= (3,33,0):
+                    # Stage the new values in a temporary table
+                    tmptable = 'update_'+table
+                    self.cur.execute('DROP TABLE IF EXISTS temp.'+tmptable)
+                    self.cur.execute('CREATE TEMP TABLE '+tmptable+'('+','.join(cols)+')')
+                    sql = 'INSERT INTO temp.'+tmptable+'('+','.join(cols)+') VALUES('+','.join(len(cols)*'?')+')'
+                    self.cur.executemany(sql,data_tuple)
+                    self.cur.execute('CREATE INDEX temp.idx_'+tmptable+' ON '+tmptable+'('+','.join(keys)+')')
+                    # Single set-based update
+                    sql = 'UPDATE '+table+' SET '
+                    sql += ','.join([c+'='+tmptable+'.'+c for c in setcols])
+                    sql += ' FROM temp.'+tmptable+' WHERE '
+                    sql += ' AND '.join([table+'.'+k+'='+tmptable+'.'+k for k in keys])
+                    self.cur.execute(sql)
+                    self.cur.execute('DROP TABLE temp.'+tmptable)
+                # Parameterized executemany
+                else:
+                    sql = 'UPDATE '+table+' SET '+','.join([c+'=?' for c in setcols])
+                    sql += ' WHERE '+' AND '.join([k+'=?' for k in keys])
+                    setind = [cols.index(c) for c in setcols+keys]
+                    rows = (tuple([d[i] for i in setind]) for d in data_tuple)
+                    self.cur.executemany(sql,rows)
+                self.db.commit()
+            except:
+                self.db.rollback()
+                raise
+            return
+            
         # condition can be a list
         if isinstance(condition,str):
-            condition = len(data_tuple)*[condition]  # make list
+            sql = "UPDATE "+table+" SET "+','.join([c+'=?' for c in cols])+" WHERE "+condition
+            self.cur.executemany(sql,data_tuple)
         elif utils.iterable(condition):
-            pass
+            # Loop over entries
+            for i in range(len(data_tuple)):
+                sql = "UPDATE "+table+" SET "+','.join([c+'=?' for c in cols])+" WHERE "+condition[i]
+                self.cur.execute(sql,data_tuple[i])
         else:
             raise ValueError('condition type not supported')
-        # Loop over entries
-        for i in range(len(data_tuple)):
-            pairs = [c+'='+d for c,d in zip(cols,data_tuple[i])]
-            vals = ','.join(pairs)
-            sql = "UPDATE "+table+" SET "+vals+" WHERE "+condition[i]
-            self.cur.execute(sql)
         self.db.commit()
         
     def dtype(self,table):
         """ Return table column dtype. """
         if self.exists(table)==False:
             return None
-        # Get table column names and data types
-        self.cur.execute("select sql from sqlite_master where tbl_name = '"+table+"' and type='table'")
-        res = self.cur.fetchall()
-        head = res[0][0]
-        # 'CREATE TABLE exposure(expnum TEXT, nchips INTEGER, filter TEXT, exptime REAL,
-        #                        utdate TEXT, uttime TEXT, airmass REAL, wcstype TEXT)'
-        lo = head.find('(')
-        hi = head.find(')')
-        head = head[lo+1:hi]
-        columns = head.split(',')
-        columns = dln.strip(columns)
         # Convert sqlite3 data types to numpy data types
-        d2d = {"TEXT":"S", "INTEGER":"i", "REAL":"f", "BLOB":"O"}
+        #  using the sqlite3 type affinity rules
         dt = []
-        for c in columns:
-            pair = c.split(' ')
-            dt.append( (pair[0], d2d[pair[1].upper()]) )
+        for c,t in self._tableinfo()[table]:
+            t = t.upper()
+            if t.find('INT')>-1:
+                kind = 'i'
+            elif t.find('CHAR')>-1 or t.find('CLOB')>-1 or t.find('TEXT')>-1:
+                kind = 'S'
+            elif t.find('BLOB')>-1 or t=='':
+                kind = 'O'
+            else:
+                kind = 'f'
+            dt.append( (c, kind) )
         dtype = np.dtype(dt)
         return dtype
 
     def tables(self):
         """ Return table names."""
-         # Get table names
-        self.cur.execute("select name from sqlite_master where type='table'")
-        res = self.cur.fetchall()
+        res = list(self._tableinfo().keys())
         if len(res)==0:
             return None
-        else:
-            res = [r[0] for r in res]
         return res
     
     def columns(self,table):
         """ Return table columns."""
         if self.exists(table)==False:
             return None
-        # Get table column names
-        self.cur.execute("select sql from sqlite_master where tbl_name = '"+table+"' and type='table'")
-        res = self.cur.fetchall()
-        head = res[0][0]
-        # 'CREATE TABLE exposure(expnum TEXT, nchips INTEGER, filter TEXT,
-        #                   exptime REAL, utdate TEXT, uttime TEXT, airmass REAL, wcstype TEXT)'
-        lo = head.find('(')
-        hi = head.find(')')
-        head = head[lo+1:hi]
-        columns = head.split(',')
-        columns = dln.strip(columns)
-        cols = []
-        for c in columns:
-            pair = c.split(' ')
-            cols.append(pair[0])
+        cols = [c for c,t in self._tableinfo()[table]]
         return cols
         
     def exists(self,name):
@@ -626,53 +1229,56 @@ class Database(object):
         if len(vals)>2:
             raise ValueError('Only TABLE or TABLE.COLUMN format supported')
         # Should allow to check for an index as well
+        info = self._tableinfo()
         # Table only
         if len(vals)==1:
             table = vals[0]
-            sql = 'SELECT name from sqlite_master where type= "table" and name="'+table+'"'
-            res = self.query(sql)
-            if len(res)>0:
-                return True
-            else:
-                return False
+            return table in info.keys()
         # Table and column input
         else:
             table = vals[0]
             column = vals[1]
             # First check that table exists
-            sql = 'SELECT * from sqlite_master where type= "table" and name="'+table+'"'
-            res = self.query(sql)
-            if len(res)==0:
+            if table not in info.keys():
                 return False
             # Then check if the column exists
-            cols = self.columns(table)
+            cols = [c for c,t in info[table]]
             if column in cols:
                 return True
             else:
                 return False
 
+    @serialized
     def sql(self,cmd):
         """ Execute raw sql command or list of sql commands."""
         if isinstance(cmd,str):
             self.cur.execute(cmd)
+            cmds = [cmd]
         elif utils.iterable(cmd):
             for c in cmd:
                 self.cur.execute(c)
+            cmds = cmd
+            cmd = cmds[-1]
         else:
             raise ValueError('sql type '+str(type(cmd))+' not supported')
         # Check if we need to commit
         docommit = False
         for c in ['insert','update','delete','merge','call',
                   'explain plan','lock table']:
-            if cmd.lower().find(c)>-1:
+            if any([m.lower().find(c)>-1 for m in cmds]):
                 docommit = True
         if docommit:
             self.db.commit()
+        # DDL statements change the schema
+        for c in ['create ','alter ','drop ']:
+            if any([m.lower().find(c)>-1 for m in cmds]):
+                self._clearschema()
         # Do we need to fetch or return anything?
         if cmd.lower().find('select ')>-1:
             data = self.cur.fetchall()
             return data
         
+    @serialized
     def create(self,name,fmt,extra=None):
         """
         Create table or column.
@@ -714,6 +1320,7 @@ class Database(object):
             sql = "ALTER TABLE "+table+" ADD COLUMN "+column+" "+sfmt
             self.cur.execute(sql)
             self.db.commit()
+            self._clearschema()
         # Table
         else:
             table = vals[0]
@@ -725,8 +1332,10 @@ class Database(object):
             if extra is not None:
                 sql += ' '+extra
             self.cur.execute(sql)
-            self.db.commit()            
+            self.db.commit()
+            self._clearschema()
 
+    @serialized
     def delete(self,table,condition):
         """
         Delete rows in a table.
@@ -735,6 +1344,7 @@ class Database(object):
         self.cur.execute(sql)
         self.db.commit()
         
+    @serialized
     def drop(self,name,fmt):
         """
         Drop/delete a table or column.
@@ -762,13 +1372,16 @@ class Database(object):
             sql = "ALTER TABLE "+table+" DROP COLUMN "+column
             self.cur.execute(sql)
             self.db.commit()
+            self._clearschema()
         # Table
         else:
             table = vals[0]
             sql = "DROP TABLE "+table
             self.cur.execute(sql)
-            self.db.commit()  
+            self.db.commit()
+            self._clearschema()
             
+    @serialized
     def analyze(self,table,verbose=False):
         """ Analyze table."""
         t0 = time.time()
@@ -778,6 +1391,7 @@ class Database(object):
         data = self.cur.fetchall()
         if verbose: print('analyzing done after {:.1f} sec'.format(time.time()-t0))
 
+    @serialized
     def createindex(self,name):
         """ Create index on column."""
         vals = name.split('.')
@@ -837,3 +1451,205 @@ class Database(object):
                 for t in tables:
                     for line in _iterdump(self.db, t):
                         f.write('%s\n' % line)        
+
+    def _export_table(self,table,directory,chunksize=1000000,compress=True,verbose=False):
+        """ Export a single table to binary files."""
+        t0 = time.time()
+        # Each thread needs its own connection
+        if self.filename is None or self.filename==':memory:':
+            db = self.db
+        else:
+            db = opendb(self.filename,readonly=True)
+        cur = db.cursor()
+        # Save the CREATE TABLE and CREATE INDEX statements
+        cur.execute("SELECT sql FROM sqlite_master WHERE tbl_name=? AND sql NOT NULL "+
+                    "ORDER BY type='index'",(table,))
+        statements = [r[0]+';' for r in cur.fetchall()]
+        with open(os.path.join(directory,table+'.sql'),'w') as f:
+            f.write('\n'.join(statements)+'\n')
+        # Write the rows in chunks, NULLs are kept in mask arrays
+        #  so the files can be loaded without pickle
+        cur.execute('SELECT * FROM "'+table+'"')
+        names = [d[0] for d in cur.description]
+        nchunks,nrows = 0,0
+        while True:
+            rows = cur.fetchmany(chunksize)
+            if len(rows)==0:
+                break
+            arrays = {'names':np.array(names,dtype=str),'nrows':np.array(len(rows))}
+            for i,values in enumerate(zip(*rows)):
+                arrays.update(_encode_column(values,'c'+str(i)))
+            outfile = os.path.join(directory,table+'.{:06d}.npz'.format(nchunks))
+            if compress:
+                np.savez_compressed(outfile,**arrays)
+            else:
+                np.savez(outfile,**arrays)
+            nchunks += 1
+            nrows += len(rows)
+            del rows,arrays
+        cur.close()
+        if db is not self.db:
+            db.close()
+        if verbose:
+            print('Exported {:d} rows of {:s} in {:.1f} sec'.format(nrows,table,time.time()-t0))
+        return nrows
+        
+    def export(self,directory,tables=None,chunksize=1000000,compress=True,
+               nthreads=1,verbose=False):
+        """
+        Export tables to compressed binary files.
+
+        Each table is written as a TABLE.sql file with the CREATE TABLE and
+        CREATE INDEX statements and TABLE.NNNNNN.npz files that each hold
+        up to chunksize rows as typed column arrays, with NULLs in boolean
+        mask arrays (see _encode_column()).  The files are loaded without
+        pickle.
+
+        Parameters
+        ----------
+        directory : str
+           Output directory.
+        tables : list, optional
+           Names of the tables to export.  Default is all tables.
+        chunksize : int, optional
+           Number of rows per file.  Default is 1000000.
+        compress : bool, optional
+           Compress the files.  Default is True.
+        nthreads : int, optional
+           Number of tables to export in parallel.  Default is 1.
+        verbose : bool, optional
+           Verbose output.  Default is False.
+
+        Returns
+        -------
+        nrows : dict
+           Number of rows exported for each table.
+
+        Examples
+        --------
+
+        db.export('/backup/registry',nthreads=4)
+
+        """
+        if tables is None:
+            tables = self.tables()
+            if tables is None:
+                tables = []
+        elif isinstance(tables,str):
+            tables = [tables]
+        if os.path.exists(directory)==False:
+            os.makedirs(directory)
+        # An in-memory database can only be used through its own connection
+        if self.filename is None or self.filename==':memory:' or self.pool:
+            nthreads = 1
+        if nthreads>1:
+            with ThreadPoolExecutor(max_workers=nthreads) as executor:
+                futures = [executor.submit(self._export_table,t,directory,chunksize,
+                                           compress,verbose) for t in tables]
+                nrows = [f.result() for f in futures]
+        else:
+            nrows = [self._export_table(t,directory,chunksize,compress,verbose) for t in tables]
+        return dict(zip(tables,nrows))
+
+    def restore(self,directory,tables=None,replace=False,verbose=False):
+        """
+        Restore tables from binary files written by export().
+
+        Parameters
+        ----------
+        directory : str
+           Directory with the exported files.
+        tables : list, optional
+           Names of the tables to restore.  Default is all tables in directory.
+        replace : bool, optional
+           Drop tables that already exist in the database and restore them.
+             Otherwise an error is raised if a table already exists.
+             Default is False.
+        verbose : bool, optional
+           Verbose output.  Default is False.
+
+        Returns
+        -------
+        nrows : dict
+           Number of rows restored for each table.
+
+        Examples
+        --------
+
+        db.restore('/backup/registry')
+
+        """
+        if os.path.exists(directory)==False:
+            raise FileNotFoundError(directory)
+        if tables is None:
+            tables = sorted([f[:-4] for f in os.listdir(directory) if f.endswith('.sql')])
+        elif isinstance(tables,str):
+            tables = [tables]
+        for t in tables:
+            if os.path.exists(os.path.join(directory,t+'.sql'))==False:
+                raise FileNotFoundError(os.path.join(directory,t+'.sql'))
+            if self.exists(t) and replace==False:
+                raise ValueError(t+' table already exists.  Use replace=True to overwrite it')
+        out = {}
+        for t in tables:
+            t0 = time.time()
+            with open(os.path.join(directory,t+'.sql'),'r') as f:
+                statements = [l.strip() for l in f.read().split(';\n') if l.strip()!='']
+            statements = [l.rstrip(';') for l in statements]
+            # Create the table, the indexes are added after the data
+            if self.exists(t):
+                self.sql('DROP TABLE "'+t+'"')
+            self.sql(statements[0])
+            files = sorted([f for f in os.listdir(directory)
+                            if f.startswith(t+'.') and f.endswith('.npz')
+                            and f[len(t)+1:-4].isdigit()])
+            nrows = 0
+            for f in files:
+                # Never unpickle objects from the files
+                with np.load(os.path.join(directory,f),allow_pickle=False) as npz:
+                    names = list(npz['names'])
+                    n = int(npz['nrows'])
+                    columns = [_decode_column(npz,'c'+str(i),n) for i in range(len(names))]
+                tab = np.zeros(n,dtype=np.dtype([(c,a.dtype) for c,a in zip(names,columns)]))
+                for c,a in zip(names,columns):
+                    tab[c] = a
+                del columns
+                self.insert(t,tab)
+                nrows += len(tab)
+            for st in statements[1:]:
+                self.sql(st.replace('CREATE INDEX','CREATE INDEX IF NOT EXISTS',1)
+                         .replace('CREATE UNIQUE INDEX','CREATE UNIQUE INDEX IF NOT EXISTS',1))
+            out[t] = nrows
+            if verbose:
+                print('Restored {:d} rows of {:s} in {:.1f} sec'.format(nrows,t,time.time()-t0))
+        return out
+
+    def backup(self,filename,pages=-1,verbose=False):
+        """
+        Make an online snapshot of the database with the sqlite3 backup API.
+
+        Parameters
+        ----------
+        filename : str
+           Output database filename.
+        pages : int, optional
+           Number of pages to copy at a time.  Writers can get in between
+             the steps.  Default is -1, copy the full database in one step.
+        verbose : bool, optional
+           Print the progress.  Default is False.
+
+        Examples
+        --------
+
+        db.backup('/backup/registry.db')
+
+        """
+        t0 = time.time()
+        def progress(status,remaining,total):
+            print('Copied {:d} of {:d} pages'.format(total-remaining,total))
+        dest = sqlite3.connect(filename)
+        try:
+            self.db.backup(dest,pages=pages,progress=progress if verbose else None)
+        finally:
+            dest.close()
+        if verbose: print('backup done after {:.1f} sec'.format(time.time()-t0))
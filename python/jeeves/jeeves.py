@@ -3,6 +3,10 @@ import numpy as np
 import traceback
 import subprocess
 from . import datamodel,utils
+from .utils import read_config,write_config,projects_filename
+from .registry import Registry,keyize
+from .container import DataContainer
+from .cache import ProductCache,DiskCache
 
 
 # Ideas
@@ -109,35 +113,179 @@ def add_datamodel(name,dmodel,project=None):
     datadir = os.path.join(directory,'data',name)
     os.makedirs(datadir)
     # create blank database
-    dbname = os.path.join(directory,'registry',name+'db')
+    dbname = os.path.join(directory,'registry',name+'.db')
     res = subprocess.run(['sqlite3',dbname],capture_output=True)
     
 class JeevesProject(object):
     """
     Jeeves Project object
+
+    Parameters
+    ----------
+    name : str
+       Project name.
+    cachebytes : int, optional
+       Byte budget of the in-memory product cache.  Default is 1GB.
+    diskcache : str, optional
+       Directory of the on-disk cache of decoded products that is shared
+         by all the processes on a node.  By default there is no disk cache.
+    diskcachebytes : int, optional
+       Byte budget of the on-disk cache.  By default there is no limit.
     """
 
-    def __init__(self,name):
+    def __init__(self,name,cachebytes=1073741824,diskcache=None,diskcachebytes=None):
         self.name = name
         self.__projects_filename = projects_filename()
+        self._registries = {}
+        self.cache = ProductCache(cachebytes)
+        self.diskcache = None
+        if diskcache is not None:
+            self.diskcache = DiskCache(diskcache,diskcachebytes)
 
+    @property
+    def directory(self):
+        """ Return the project directory."""
+        if hasattr(self,'_directory')==False:
+            pconfig = read_config(self.__projects_filename)
+            if self.name not in pconfig.keys():
+                raise ValueError(str(self.name)+' not found')
+            self._directory = pconfig[self.name]['directory']
+        return self._directory
+        
     def initialize(self):
         init_project(self.name)
 
-    def read(self,kind,key):
-        """ Read a file."""
-        # Open the registry (if it's not open already
-        # perform the query
-        registry.query()
+    def registry(self,kind):
+        """ Return the registry for a file type."""
+        if kind not in self._registries.keys():
+            dbname = os.path.join(self.directory,'registry',kind+'.db')
+            # Metadata keywords to index from the datamodel config file
+            metakeys = None
+            dconfigfile = os.path.join(self.directory,'config',kind+'.yaml')
+            if os.path.exists(dconfigfile):
+                dconfig = read_config(dconfigfile)
+                if isinstance(dconfig,dict):
+                    metakeys = dconfig.get('metakeys')
+            self._registries[kind] = Registry(database_filename=dbname,metakeys=metakeys)
+        return self._registries[kind]
+        
+    def filename(self,kind,key):
+        """ Return the filename of a product from the registry."""
+        filename = self.registry(kind).retrieve(key)
+        if filename is None:
+            raise KeyError(str(key)+' not found in the '+str(kind)+' registry')
+        # Relative to the data directory of the file type
+        if os.path.isabs(filename)==False and os.path.exists(filename)==False:
+            filename = os.path.join(self.directory,'data',kind,filename)
+        return filename
+        
+    def read(self,kind,key,cache=True):
+        """
+        Read a product.
+
+        The file is looked up in the registry and the decoded product is
+        kept in the in-memory product cache, keyed by the file modification
+        time, so repeated reads of an unchanged file do not reopen it.
+        Products that are not in memory are next looked for in the
+        on-disk cache (if there is one) before the file is decoded.
+
+        Parameters
+        ----------
+        kind : str
+           The file type/datamodel name.
+        key : str
+           The product key.
+        cache : bool, optional
+           Use the product caches.  Default is True.
+
+        Returns
+        -------
+        container : DataContainer
+           The product.  Cached products share their (read-only) data
+             until they are changed, see DataContainer.copy().
+
+        Examples
+        --------
+
+        bias = proj.read('bias','20231004')
+
+        """
+        filename = self.filename(kind,key)
+        if os.path.exists(filename)==False:
+            raise FileNotFoundError(filename)
+        if cache==False:
+            return DataContainer.read(filename)
+        key = keyize(key)
+        mtime = os.stat(filename).st_mtime_ns
+        container = self.cache.get(kind,key,mtime)
+        if container is None:
+            if self.diskcache is not None:
+                container = self.diskcache.get(filename)
+            if container is None:
+                container = DataContainer.read(filename)
+                if self.diskcache is not None:
+                    self.diskcache.put(filename,container)
+            container = self.cache.put(kind,key,mtime,container)
+        return container
 
     def write(self,data,kind,key):
         """ Write a file ."""
         pass
 
-    def register(self,files):
-        """ Add files to the registry."""
-        pass
+    def register(self,kind,records,**kwargs):
+        """
+        Add files to the registry.
 
+        Parameters
+        ----------
+        kind : str
+           The file type/datamodel name.
+        records : iterable
+           Iterable or generator of (key, filename) or (key, filename, metadata)
+             records.
+        **kwargs
+           Extra keywords passed on to Registry.register().
+
+        Returns
+        -------
+        count : int
+           Number of rows added to the registry.
+
+        Examples
+        --------
+
+        count = proj.register('exposure',records)
+
+        """
+        return self.registry(kind).register(records,**kwargs)
+
+    def search(self,kind,where=None,**criteria):
+        """
+        Search the registry metadata of a file type.
+
+        Parameters
+        ----------
+        kind : str
+           The file type/datamodel name.
+        where : str, optional
+           WHERE condition, e.g. "filter='r' AND exptime>30".
+        **criteria
+           Column values to match.  A (low,high) tuple selects a range.
+
+        Returns
+        -------
+        tab : numpy structured array
+           The matching registry rows.
+
+        Examples
+        --------
+
+        tab = proj.search('exposure',filter='r',ra=(10.0,12.0),dec=(-5.0,-3.0),
+                          date_obs=('2023-10-01','2023-10-08'))
+
+        """
+        return self.registry(kind).find(where=where,**criteria)
+        
     def exists(self,kind,key):
         """ Check if data exists."""
         pass
@@ -5,29 +5,104 @@ import numpy as np
 from dlnpyutils import utils as dln
 import time
 import sqlite3
+import re
+from astropy.io import fits
 from . import utils
+from .database import opendb,_fetch_columnar
+from .skyindex import SkyGrid,wcs_footprint,angsep
+from .container import scanheaders
 
 # Jeeves registry database
 
 def keyize(key):
     """ Make key into a single string."""
-    if utils.iterable(key):
+    if utils.iterable(key) and isinstance(key,str)==False:
         keylist = [str(k) for k in key]
         skey = '----'.join(keylist)
     else:
         skey = str(key)
     return skey
 
+def metacolumn(key):
+    """ Convert a header keyword into a registry column name."""
+    return re.sub('[^a-z0-9_]','_',key.lower())
+
+def extract_metadata(meta,metakeys):
+    """
+    Extract typed metadata values from a header.
+
+    Parameters
+    ----------
+    meta : MetaData, fits Header or dict
+       The header/metadata.
+    metakeys : dict
+       Dictionary of header keywords and their sqlite3 data types,
+         e.g. {'DATE-OBS':'text','RA':'real','EXPTIME':'real'}.
+
+    Returns
+    -------
+    values : dict
+       Dictionary of registry column names and values.  Missing
+         keywords are set to None.
+
+    Examples
+    --------
+
+    values = extract_metadata(head,{'FILTER':'text','EXPTIME':'real'})
+
+    """
+    # Convert values to the column data types
+    convert = {'TEXT':str, 'INTEGER':int, 'REAL':float}
+    values = {}
+    for k,dtype in metakeys.items():
+        if hasattr(meta,'get'):
+            val = meta.get(k)
+            # Scanned keywords are upper case
+            if val is None:
+                val = meta.get(k.upper())
+            if val is None:
+                val = meta.get(metacolumn(k))
+        else:
+            val = getattr(meta,k.lower(),None)
+        if val is not None:
+            try:
+                val = convert.get(dtype.upper(),str)(val)
+            except ValueError:
+                val = None
+        values[metacolumn(k)] = val
+    return values
+
 class Registry(object):
     """
     Jeeves registry or database
+
+    Parameters
+    ----------
+    configfile : str, optional
+       Registry configuration file.
+    database_filename : str, optional
+       Registry database filename.
+    metakeys : dict, optional
+       Header keywords and their data types to store in indexed columns
+         of the registry table, e.g. {'DATE-OBS':'text','RA':'real'}.
+         Can also be given with 'metakeys' in the configuration file.
+    pixsize : float, optional
+       Pixel size (deg) of the sky index for cone and box searches.  This is
+         only used when the sky index is first created.  Default is 0.5.
+
     """
 
-    def __init__(self,configfile):
+    def __init__(self,configfile=None,database_filename=None,metakeys=None,pixsize=0.5):
         self.configfile = None
-        self.database_filename = None
+        self.database_filename = database_filename
         self.datamodel_filename = None
-        return
+        self.metakeys = metakeys
+        self.pixsize = pixsize
+        self._skygrid = None
+        self._db = None
+        self._cur = None
+        if configfile is None:
+            return
         self.configfile = configfile
         # Load config file
         if os.path.exists(configfile)==False:
@@ -35,9 +110,8 @@ class Registry(object):
         self.config = utils.read_config(configfile)
         self.database_filename = self.config['database_filename']
         self.datamodel_filename = self.config['datamodel_filename']
-        # initialize
-        #self._db = None
-        #self._cur = None
+        if metakeys is None:
+            self.metakeys = self.config.get('metakeys')
 
     def __repr__(self):
         """ Print info """
@@ -52,21 +126,42 @@ class Registry(object):
             raise ValueError('No database filename')
         if self._db is None:
             self._db = opendb(self.database_filename)
+            # Make sure the registry table and key index exist
+            self.initregistrytable()
         
     def closedb(self):
         """ Close the database."""
         if self._db is not None:
-            if self.cur is not None:
-                self.cur.close()  # close cursor first
+            if self._cur is not None:
+                self._cur.close()  # close cursor first
+                self._cur = None
             self._db.close()
-
-    
+            self._db = None
             
     def initregistrytable(self):
         """ Initialize registry table."""
-        self.cur.execute('CREATE TABLE registry (key text, filename text)')
+        self.cur.execute('CREATE TABLE IF NOT EXISTS registry (key text, filename text)')
+        # Unique index on the key so lookups don't scan the table
+        try:
+            self.cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_key_registry ON registry(key)')
+        except sqlite3.IntegrityError:
+            # Older registries can have duplicate keys, use a plain index
+            self.cur.execute('SELECT key,count(*) FROM registry GROUP BY key HAVING count(*)>1')
+            dups = self.cur.fetchall()
+            print('Registry has '+str(len(dups))+' duplicate keys, not making the key index unique: '+
+                  ', '.join([str(d[0])+' ('+str(d[1])+')' for d in dups[:10]])+
+                  (' ...' if len(dups)>10 else ''))
+            self.cur.execute('CREATE INDEX IF NOT EXISTS idx_key_registry ON registry(key)')
+        # Typed and indexed columns for the meta-data
+        if self.metakeys is not None:
+            self.cur.execute("PRAGMA table_info('registry')")
+            regcols = [r[1] for r in self.cur.fetchall()]
+            for k,dtype in self.metakeys.items():
+                col = metacolumn(k)
+                if col not in regcols:
+                    self.cur.execute('ALTER TABLE registry ADD COLUMN '+col+' '+dtype)
+                self.cur.execute('CREATE INDEX IF NOT EXISTS idx_'+col+'_registry ON registry('+col+')')
         self.db.commit()
-        # Need to make columns for the meta-data
         
         # Make foreign key between registry and data tables
         
@@ -92,8 +187,8 @@ class Registry(object):
     def search(self,key):
         """ Search for the key in the table."""
         skey = keyize(key)
-        sql = "select * from registry where key='"+skey+"'"
-        self.cur.execute(sql)
+        sql = "select * from registry where key=?"
+        self.cur.execute(sql,(skey,))
         res = self.cur.fetchall()
         return res
 
@@ -111,29 +206,446 @@ class Registry(object):
         if len(res)==0:
             return None
         else:
-            return res['filename']
+            return res[0][1]
+
+    def _lookup_many(self,keys):
+        """ Look up many keys in one query through a temporary table join."""
+        skeys = [keyize(k) for k in keys]
+        cur = self.db.cursor()
+        cur.execute('CREATE TEMP TABLE IF NOT EXISTS lookupkeys (key text)')
+        cur.execute('DELETE FROM lookupkeys')
+        cur.executemany('INSERT INTO lookupkeys (key) VALUES (?)',[(k,) for k in skeys])
+        cur.execute('SELECT r.key,r.filename FROM lookupkeys l JOIN registry r ON r.key=l.key')
+        res = dict(cur.fetchall())
+        cur.execute('DELETE FROM lookupkeys')
+        cur.close()
+        # End the implicit transaction so no locks or snapshot are held
+        self.db.commit()
+        return skeys,res
+        
+    def exists_many(self,keys):
+        """
+        Check if many keys exist in the registry.
+
+        Parameters
+        ----------
+        keys : list
+           List of keys.
+
+        Returns
+        -------
+        exists : numpy array
+           Boolean array, True if the key exists in the registry.
 
+        Examples
+        --------
+
+        exists = reg.exists_many(keys)
+
+        """
+        skeys,res = self._lookup_many(keys)
+        exists = np.array([k in res for k in skeys],bool)
+        return exists
+        
+    def retrieve_many(self,keys):
+        """
+        Retrieve the filenames for many keys.
+
+        Parameters
+        ----------
+        keys : list
+           List of keys.
+
+        Returns
+        -------
+        filenames : list
+           List of filenames.  None for keys that are not in the registry.
+
+        Examples
+        --------
+
+        filenames = reg.retrieve_many(keys)
+
+        """
+        skeys,res = self._lookup_many(keys)
+        filenames = [res.get(k) for k in skeys]
+        return filenames
+    
     def add(self,key,filename):
         """ Add data to the registry."""
         skey = keyize(key)
-        sql = "insert into registry (key,filename) values ('"+skey+"','"+filename+"')"
-        self.cur.execute(sql)
-        self.cur.commit()
+        sql = "insert into registry (key,filename) values (?,?)"
+        self.cur.execute(sql,(skey,filename))
+        self.db.commit()
 
     def delete(self,key,hard=True):
         """ Delete data from registry."""
         skey = keyize(key)
-        sql = "select * from registry where key='"+skey+"'"
-        self.cur.execute(sql)
-        res = cur.fetchall()
+        sql = "select * from registry where key=?"
+        self.cur.execute(sql,(skey,))
+        res = self.cur.fetchall()
         if len(res)==0:
             return
-        filename = res['filename']
-        # Delete the row in the reistry
-        sql = "delete from registry where key='"+skey+"'"
-        self.cur.execute(sql)
-        self.cur.commit()
+        filename = res[0][1]
+        # Delete the row in the registry and the sky index in one transaction
+        try:
+            sql = "delete from registry where key=?"
+            self.cur.execute(sql,(skey,))
+            self._deletefootprints([skey])
+            self.db.commit()
+        except:
+            self.db.rollback()
+            raise
         # Delete file as well
         if hard:
             if os.path.exists(filename):
                 os.remove(filename)
+
+    def _recordheader(self,rec,footprints=False,scanned=None):
+        """ Get the metadata/header of a registration record."""
+        meta = None
+        if len(rec)>2:
+            meta = rec[2]
+        # Use the scanned header keywords
+        if meta is None and scanned is not None and rec[1] in scanned:
+            meta = scanned[rec[1]]
+        # Get the header from the file
+        if meta is None and (self.metakeys is not None or footprints):
+            meta = fits.getheader(rec[1])
+        return meta
+        
+    def _recordmetadata(self,meta):
+        """ Get the metadata column values of a registration record."""
+        if meta is None:
+            return {}
+        # Extract the configured keywords
+        if self.metakeys is not None:
+            return extract_metadata(meta,self.metakeys)
+        if isinstance(meta,dict):
+            return {metacolumn(k):v for k,v in meta.items()}
+        return {}
+        
+    def register(self,records,chunksize=10000,journal_mode='WAL',synchronous='NORMAL',
+                 replace=False,footprints=False,nthreads=1,verbose=True):
+        """
+        Bulk add data to the registry.
+
+        Parameters
+        ----------
+        records : iterable
+           Iterable or generator of (key, filename) or (key, filename, metadata)
+             records.  metadata is a dictionary of values for additional
+             columns of the registry table, or a MetaData object or FITS header
+             to extract the metakeys values from.  If metakeys are configured
+             and no metadata is given, the values are read from the file header.
+        chunksize : int, optional
+           Number of rows to insert per executemany batch.  Default is 10000.
+        journal_mode : str, optional
+           The sqlite3 journal mode to use.  Default is 'WAL'.
+        synchronous : str, optional
+           The sqlite3 synchronous setting to use.  Default is 'NORMAL'.
+        replace : bool, optional
+           Replace existing rows with the same key.  Default is False.
+        footprints : bool, optional
+           Add the WCS footprints to the sky index.  Default is False.
+        nthreads : int, optional
+           Number of threads to scan the file headers for the metakeys
+             values with.  Default is 1.
+        verbose : bool, optional
+           Print out the number of rows and rows/sec at the end.  Default is True.
+
+        Returns
+        -------
+        count : int
+           Number of rows added to the registry.
+
+        Examples
+        --------
+
+        count = reg.register(records)
+
+        """
+        t0 = time.time()
+        # Pragmas can't be changed inside a transaction
+        self.db.commit()
+        if journal_mode is not None:
+            self.cur.execute('PRAGMA journal_mode='+journal_mode)
+        if synchronous is not None:
+            self.cur.execute('PRAGMA synchronous='+synchronous)
+        self.cur.execute("PRAGMA table_info('registry')")
+        regcols = [r[1] for r in self.cur.fetchall()]
+        if replace:
+            insert = 'INSERT OR REPLACE INTO registry'
+        else:
+            insert = 'INSERT INTO registry'
+        # All the rows are added in a single transaction
+        count = 0
+        metacols = None
+        try:
+            for chunk in utils.chunks(records,chunksize):
+                if metacols is None:
+                    # Use the configured metadata columns, otherwise
+                    #  get them from the first record
+                    if self.metakeys is not None:
+                        metacols = [metacolumn(k) for k in self.metakeys.keys()]
+                    else:
+                        metacols = []
+                        if len(chunk[0])>2 and isinstance(chunk[0][2],dict):
+                            metacols = [metacolumn(k) for k in chunk[0][2].keys()
+                                        if metacolumn(k) in regcols]
+                    cols = ['key','filename']+metacols
+                    sql = insert+' ('+','.join(cols)+') VALUES ('+','.join(len(cols)*'?')+')'
+                # Only the metakeys are needed, scan the raw headers
+                scanned = None
+                if self.metakeys is not None and footprints==False:
+                    files = [rec[1] for rec in chunk if len(rec)<3 or rec[2] is None]
+                    if len(files)>0:
+                        values = scanheaders(files,list(self.metakeys.keys()),nthreads=nthreads)
+                        scanned = dict(zip(files,values))
+                rows = []
+                fprecs = []
+                for rec in chunk:
+                    row = [keyize(rec[0]),rec[1]]
+                    meta = None
+                    if len(metacols)>0 or footprints:
+                        meta = self._recordheader(rec,footprints,scanned)
+                    if len(metacols)>0:
+                        values = self._recordmetadata(meta)
+                        row += [values.get(c) for c in metacols]
+                    if footprints and meta is not None and isinstance(meta,dict)==False:
+                        fp = wcs_footprint(meta)
+                        if fp is not None:
+                            fprecs.append((row[0],)+fp)
+                    rows.append(row)
+                # The old footprints of replaced entries are removed
+                if replace:
+                    self._deletefootprints([row[0] for row in rows])
+                self.cur.executemany(sql,rows)
+                if len(fprecs)>0:
+                    self._insertfootprints(fprecs)
+                count += len(rows)
+            self.db.commit()
+        except:
+            self.db.rollback()
+            raise
+        dt = time.time()-t0
+        if verbose:
+            print('Registered {:d} rows in {:.1f} sec ({:.1f} rows/sec)'.format(count,dt,count/max(dt,1e-9)))
+        return count
+
+    def find(self,where=None,**criteria):
+        """
+        Find registry entries using the metadata columns.
+
+        Parameters
+        ----------
+        where : str, optional
+           WHERE condition, e.g. "filter='r' AND exptime>30".
+        **criteria
+           Column values to match.  A (low,high) tuple selects a range
+             (inclusive).  The names can also be given as header keywords
+             (e.g. date_obs or DATE-OBS).
+
+        Returns
+        -------
+        tab : numpy structured array
+           The matching registry rows.
+
+        Examples
+        --------
+
+        tab = reg.find(filter='r',ra=(10.0,12.0),dec=(-5.0,-3.0),
+                       date_obs=('2023-10-01','2023-10-08'))
+
+        """
+        self.cur.execute("PRAGMA table_info('registry')")
+        regcols = [r[1] for r in self.cur.fetchall()]
+        conds = []
+        params = []
+        if where is not None:
+            conds.append('('+where+')')
+        for k,v in criteria.items():
+            col = metacolumn(k)
+            if col not in regcols:
+                raise ValueError(str(k)+' is not a registry column')
+            if isinstance(v,(tuple,list)) and len(v)==2:
+                conds.append(col+' BETWEEN ? AND ?')
+                params += list(v)
+            else:
+                conds.append(col+'=?')
+                params.append(v)
+        sql = 'SELECT * FROM registry'
+        if len(conds)>0:
+            sql += ' WHERE '+' AND '.join(conds)
+        cur = self.db.cursor()
+        cur.execute(sql,params)
+        tab = _fetch_columnar(cur)
+        cur.close()
+        return tab
+
+    @property
+    def skygrid(self):
+        """ Return the sky index pixelization."""
+        if self._skygrid is None:
+            self._initskytables()
+        return self._skygrid
+        
+    def _initskytables(self):
+        """ Initialize the sky index tables."""
+        cur = self.db.cursor()
+        cur.execute('CREATE TABLE IF NOT EXISTS skygrid (pixsize real)')
+        cur.execute('SELECT pixsize FROM skygrid')
+        res = cur.fetchall()
+        # The pixel size is fixed once the index exists
+        if len(res)==0:
+            cur.execute('INSERT INTO skygrid (pixsize) VALUES (?)',(self.pixsize,))
+            pixsize = self.pixsize
+        else:
+            pixsize = res[0][0]
+        cur.execute('CREATE TABLE IF NOT EXISTS footprint (key text PRIMARY KEY, ra real, dec real, radius real)')
+        cur.execute('CREATE TABLE IF NOT EXISTS skyindex (key text, pix integer)')
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_pix_skyindex ON skyindex(pix)')
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_key_skyindex ON skyindex(key)')
+        self.db.commit()
+        cur.close()
+        self._skygrid = SkyGrid(pixsize)
+
+    def _deletefootprints(self,keys):
+        """ Delete the footprints and sky index rows of keys without committing."""
+        self.cur.execute("SELECT count(*) FROM sqlite_master WHERE type='table' AND name='footprint'")
+        if self.cur.fetchone()[0]==0:
+            return
+        keys = [(k,) for k in keys]
+        self.cur.executemany('DELETE FROM footprint WHERE key=?',keys)
+        self.cur.executemany('DELETE FROM skyindex WHERE key=?',keys)
+
+    def _insertfootprints(self,fprecs):
+        """ Insert (key,ra,dec,radius) footprints without committing."""
+        grid = self.skygrid
+        self.cur.executemany('DELETE FROM skyindex WHERE key=?',[(f[0],) for f in fprecs])
+        self.cur.executemany('INSERT OR REPLACE INTO footprint (key,ra,dec,radius) VALUES (?,?,?,?)',fprecs)
+        for key,ra,dec,radius in fprecs:
+            pix = grid.cone_pixels(ra,dec,radius)
+            self.cur.executemany('INSERT INTO skyindex (key,pix) VALUES (?,?)',
+                                 [(key,int(p)) for p in pix])
+        
+    def add_footprints(self,records):
+        """
+        Add footprints to the sky index.
+
+        Parameters
+        ----------
+        records : iterable
+           Iterable of (key, footprint) records.  footprint can be a WCS,
+             MetaData object or FITS header, or a (ra,dec,radius) tuple
+             of the bounding circle (deg).
+
+        Returns
+        -------
+        count : int
+           Number of footprints added.
+
+        Examples
+        --------
+
+        reg.add_footprints([(key,head)])
+
+        """
+        fprecs = []
+        for key,inp in records:
+            if isinstance(inp,(tuple,list)):
+                fp = tuple(inp)
+            else:
+                fp = wcs_footprint(inp)
+            if fp is not None:
+                fprecs.append((keyize(key),)+fp)
+        try:
+            self._insertfootprints(fprecs)
+            self.db.commit()
+        except:
+            self.db.rollback()
+            raise
+        return len(fprecs)
+
+    def _skycandidates(self,ranges):
+        """ Get the footprints in the pixel ranges."""
+        sql = 'SELECT DISTINCT f.key,f.ra,f.dec,f.radius FROM skyindex s JOIN footprint f ON f.key=s.key WHERE '
+        sql += ' OR '.join(len(ranges)*['s.pix BETWEEN ? AND ?'])
+        params = [int(v) for r in ranges for v in r]
+        cur = self.db.cursor()
+        cur.execute(sql,params)
+        res = cur.fetchall()
+        cur.close()
+        if len(res)==0:
+            return np.array([]),np.array([]),np.array([]),np.array([])
+        keys,ra,dec,radius = zip(*res)
+        return np.array(keys),np.array(ra),np.array(dec),np.array(radius)
+        
+    def cone_search(self,ra,dec,radius):
+        """
+        Find the entries with footprints that overlap a cone.
+
+        Parameters
+        ----------
+        ra, dec : float
+           Center of the cone (deg).
+        radius : float
+           Radius of the cone (deg).
+
+        Returns
+        -------
+        keys : numpy array
+           Keys of the overlapping entries.
+
+        Examples
+        --------
+
+        keys = reg.cone_search(10.0,-5.0,0.1)
+
+        """
+        ranges = self.skygrid.cone_ranges(ra,dec,radius)
+        keys,fra,fdec,fradius = self._skycandidates(ranges)
+        if len(keys)==0:
+            return keys
+        # Use the footprint bounding circles
+        good = angsep(ra,dec,fra,fdec) <= radius+fradius
+        return keys[good]
+
+    def box_search(self,ramin,ramax,decmin,decmax):
+        """
+        Find the entries with footprints that overlap an RA/DEC box.
+
+        Parameters
+        ----------
+        ramin, ramax : float
+           RA limits (deg).  ramin>ramax means the box wraps through RA=0,
+             ramax-ramin>=360 covers the full RA range.
+        decmin, decmax : float
+           DEC limits (deg).
+
+        Returns
+        -------
+        keys : numpy array
+           Keys of the overlapping entries.
+
+        Examples
+        --------
+
+        keys = reg.box_search(350.0,10.0,-5.0,5.0)
+
+        """
+        ranges = self.skygrid.box_ranges(ramin,ramax,decmin,decmax)
+        keys,fra,fdec,fradius = self._skycandidates(ranges)
+        if len(keys)==0:
+            return keys
+        # Closest point of the box to the footprint centers
+        if ramax-ramin>=360:
+            width = 360.0   # full ring
+        else:
+            width = (ramax-ramin) % 360
+        racen = ramin+0.5*width
+        dra = (fra-racen+180) % 360 - 180
+        rabox = racen+np.clip(dra,-0.5*width,0.5*width)
+        decbox = np.clip(fdec,decmin,decmax)
+        good = angsep(rabox,decbox,fra,fdec) <= fradius
+        return keys[good]
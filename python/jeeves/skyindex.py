@@ -0,0 +1,202 @@
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS
+
+# Jeeves spatial sky index
+#
+# The sky is split into declination zones of height pixsize and every
+# zone into RA cells of roughly the same width, so the pixels have about
+# the same area.  The pixels are numbered zone by zone in RA order, so the
+# pixels of any RA/Dec box or cone are a short list of contiguous integer
+# ranges (one per zone) that can be looked up on an indexed column.
+
+def angsep(ra1,dec1,ra2,dec2):
+    """ Angular separation in degrees (haversine formula)."""
+    ra1,dec1 = np.radians(ra1),np.radians(dec1)
+    ra2,dec2 = np.radians(ra2),np.radians(dec2)
+    sdec = np.sin((dec2-dec1)/2)
+    sra = np.sin((ra2-ra1)/2)
+    a = sdec**2 + np.cos(dec1)*np.cos(dec2)*sra**2
+    return np.degrees(2*np.arcsin(np.minimum(np.sqrt(a),1.0)))
+
+def wcs_footprint(inp,shape=None):
+    """
+    Get the bounding circle of an image footprint from its WCS.
+
+    Parameters
+    ----------
+    inp : WCS, MetaData or fits Header
+       The WCS or header with the WCS.
+    shape : tuple, optional
+       The (NAXIS1,NAXIS2) size of the image.  By default this is taken
+         from the header.
+
+    Returns
+    -------
+    ra : float
+       RA of the center of the footprint (deg).
+    dec : float
+       DEC of the center of the footprint (deg).
+    radius : float
+       Radius of the bounding circle (deg).
+    None is returned if there is no celestial WCS.
+
+    Examples
+    --------
+
+    ra,dec,radius = wcs_footprint(head)
+
+    """
+    header = None
+    if isinstance(inp,WCS):
+        w = inp
+    elif isinstance(inp,fits.Header):
+        header = inp
+        w = WCS(inp)
+    else:
+        header = inp.header
+        w = inp.wcs
+    if w is None or w.has_celestial==False:
+        return None
+    if shape is None:
+        if header is None:
+            if w.pixel_shape is None:
+                return None
+            shape = w.pixel_shape
+        else:
+            shape = (header.get('NAXIS1',0),header.get('NAXIS2',0))
+    if shape[0]==0 or shape[1]==0:
+        return None
+    corners = w.celestial.calc_footprint(axes=shape)
+    # Center from the mean of the corner unit vectors
+    ra,dec = np.radians(corners[:,0]),np.radians(corners[:,1])
+    x = np.mean(np.cos(dec)*np.cos(ra))
+    y = np.mean(np.cos(dec)*np.sin(ra))
+    z = np.mean(np.sin(dec))
+    rac = np.degrees(np.arctan2(y,x)) % 360
+    decc = np.degrees(np.arctan2(z,np.sqrt(x**2+y**2)))
+    radius = np.max(angsep(rac,decc,corners[:,0],corners[:,1]))
+    return float(rac),float(decc),float(radius)
+
+
+class SkyGrid(object):
+    """
+    Equal-area RA/Dec zone pixelization of the sky.
+
+    Parameters
+    ----------
+    pixsize : float, optional
+       Size of the pixels in degrees.  Default is 0.5.
+
+    """
+
+    def __init__(self,pixsize=0.5):
+        self.pixsize = pixsize
+        self.nzones = int(np.ceil(180.0/pixsize))
+        self.zoneheight = 180.0/self.nzones
+        declo = -90.0+np.arange(self.nzones)*self.zoneheight
+        dechi = declo+self.zoneheight
+        # Use the widest part of the zone
+        mindec = np.minimum(np.abs(declo),np.abs(dechi))
+        mindec[(declo<0) & (dechi>0)] = 0.0
+        self.nra = np.maximum(np.ceil(360.0*np.cos(np.radians(mindec))/self.zoneheight),1).astype(int)
+        self.offset = np.concatenate(([0],np.cumsum(self.nra)))
+        self.npix = self.offset[-1]
+
+    def __repr__(self):
+        """ Print info """
+        return '<Jeeves.SkyGrid pixsize={:.3f} deg, {:d} pixels>'.format(self.pixsize,self.npix)
+
+    def zone(self,dec):
+        """ Return the zone number of declinations."""
+        return np.clip(np.floor((np.asarray(dec)+90.0)/self.zoneheight).astype(int),0,self.nzones-1)
+
+    def ang2pix(self,ra,dec):
+        """ Return the pixel numbers of RA/DEC positions (deg)."""
+        z = self.zone(dec)
+        nra = self.nra[z]
+        ri = np.clip(np.floor((np.asarray(ra) % 360)/360.0*nra).astype(int),0,nra-1)
+        return self.offset[z]+ri
+
+    def _zoneranges(self,z,ramin,ramax):
+        """ Pixel ranges for an RA interval in a zone."""
+        nra = self.nra[z]
+        off = self.offset[z]
+        # Full ring
+        if ramax-ramin>=360:
+            return [(off,off+nra-1)]
+        ramin,ramax = ramin % 360, ramax % 360
+        i0 = min(int(np.floor(ramin/360.0*nra)),nra-1)
+        i1 = min(int(np.floor(ramax/360.0*nra)),nra-1)
+        # Wraps through RA=0
+        if ramin>ramax:
+            return [(off,off+i1),(off+i0,off+nra-1)]
+        return [(off+i0,off+i1)]
+
+    def box_ranges(self,ramin,ramax,decmin,decmax):
+        """
+        Pixel ranges that cover an RA/DEC box.
+
+        Parameters
+        ----------
+        ramin, ramax : float
+           RA limits (deg).  ramin>ramax means the box wraps through RA=0.
+        decmin, decmax : float
+           DEC limits (deg).
+
+        Returns
+        -------
+        ranges : list
+           List of (lo,hi) inclusive pixel ranges.
+
+        Examples
+        --------
+
+        ranges = grid.box_ranges(350.0,10.0,-5.0,5.0)
+
+        """
+        if ramin>ramax:
+            ramax += 360
+        ranges = []
+        for z in range(self.zone(decmin),self.zone(decmax)+1):
+            ranges += self._zoneranges(z,ramin,ramax)
+        return ranges
+
+    def cone_ranges(self,ra,dec,radius):
+        """
+        Pixel ranges that cover a cone.
+
+        Parameters
+        ----------
+        ra, dec : float
+           Center of the cone (deg).
+        radius : float
+           Radius of the cone (deg).
+
+        Returns
+        -------
+        ranges : list
+           List of (lo,hi) inclusive pixel ranges.
+
+        Examples
+        --------
+
+        ranges = grid.cone_ranges(10.0,-5.0,0.2)
+
+        """
+        decmin = max(dec-radius,-90.0)
+        decmax = min(dec+radius,90.0)
+        # RA half-width of the cone, all RAs if it contains a pole
+        if np.abs(dec)+radius>=90.0:
+            halfwidth = 180.0
+        else:
+            halfwidth = np.degrees(np.arcsin(min(np.sin(np.radians(radius))/np.cos(np.radians(dec)),1.0)))
+        ranges = []
+        for z in range(self.zone(decmin),self.zone(decmax)+1):
+            ranges += self._zoneranges(z,ra-halfwidth,ra+halfwidth)
+        return ranges
+
+    def cone_pixels(self,ra,dec,radius):
+        """ Return all the pixel numbers that cover a cone."""
+        ranges = self.cone_ranges(ra,dec,radius)
+        return np.concatenate([np.arange(lo,hi+1) for lo,hi in ranges])
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+from astropy.table import Table
+from jeeves.container import DataBucket,DataContainer
+
+
+def makecontainer():
+    dc = DataContainer()
+    dc.add_bucket(DataBucket(np.zeros((3,4)),None,'sci'),'sci')
+    dc.add_bucket(DataBucket(Table({'a':[1,2,3]}),None,'cat'),'cat')
+    return dc
+
+def test_copy_is_deep():
+    b = DataBucket(np.zeros((3,4)),None,'sci')
+    c = b.copy()
+    b.data[0,0] = 5
+    assert c.data[0,0]==0
+    c.data[1,1] = 7
+    assert b.data[1,1]==0
+
+def test_container_copy_is_deep():
+    dc = makecontainer()
+    new = dc.copy()
+    dc.sci.data *= 2
+    dc.sci.data += 1
+    new.cat.data['a'][0] = 10
+    assert np.all(new.sci.data==0)
+    assert dc.cat.data['a'][0]==1
+
+def test_slice_and_add_are_independent():
+    dc = makecontainer()
+    part = dc[0:1]
+    part.sci.data[0,0] = 3
+    assert dc.sci.data[0,0]==0
+    new = dc + DataBucket(np.ones(2),None,'extra')
+    new.sci.data[0,0] = 4
+    assert dc.sci.data[0,0]==0
+
+def test_shared_copy_original_write():
+    b = DataBucket(np.zeros((3,4)),None,'sci')
+    c = b.copy(deep=False)
+    # Shared data is read-only on both sides
+    with pytest.raises(ValueError):
+        b.data[0,0] = 5
+    b[0,0] = 5
+    assert b.data[0,0]==5
+    assert c.data[0,0]==0
+
+def test_shared_copy_copy_write():
+    b = DataBucket(np.zeros((3,4)),None,'sci')
+    c = b.copy(deep=False)
+    with pytest.raises(ValueError):
+        c.data[0,0] = 5
+    c[0,0] = 5
+    assert c.data[0,0]==5
+    assert b.data[0,0]==0
+
+def test_shared_copy_table():
+    b = DataBucket(Table({'a':[1,2,3]}),None,'cat')
+    c = b.copy(deep=False)
+    c['a'] = [4,5,6]
+    b[0] = (9,)
+    assert list(b.data['a'])==[9,2,3]
+    assert list(c.data['a'])==[4,5,6]
@@ -1,5 +1,7 @@
 import os
 import numpy as np
+import yaml
+import itertools
 from scipy.special import erf
 from functools import wraps
 from scipy import interpolate
@@ -271,6 +273,17 @@ def is_binaryfile(filename):
     except UnicodeDecodeError: # Found non-text data
         return True  
 
+def chunks(iterable,size):
+    """
+    Split an iterable or generator into lists of at most size elements.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator,size))
+        if len(chunk)==0:
+            return
+        yield chunk
+
 def iterable(obj):
     """
     Check if object is iterable.